@@ -0,0 +1,460 @@
+"""
+Асинхронный движок переноса (TRANSFER_WORKERS_MODE=async).
+
+Сетевые стадии идут в одном цикле событий через httpx: метаданные Spotify,
+скачивание и загрузка обложек, загрузка треков в Яндекс Музыку.
+У Spotify API, Яндекс Музыки (на каждый токен) и CDN обложек свои AsyncClient
+со своими пулами keep-alive соединений. В пулах потоков остаются скачивание spotdl
+(поиск источника и ffmpeg), запросы к базе и CatalogLinker с поиском в каталоге.
+"""
+import asyncio
+import functools
+import io
+import json
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable
+
+import httpx
+from yandex_music.utils.request import HEADERS, USER_AGENT, Request
+
+import cover
+import logic
+import metrics
+import models
+import queries
+from cache import metadata_cache
+from config import (
+    SPOTIFY_CLIENT_ID,
+    SPOTIFY_CLIENT_SECRET,
+    TRANSFER_WORKERS,
+    TRANSFER_WORKERS_PER_USER,
+    TRANSFER_LEASE_SECONDS,
+    SPOTIFY_PREFETCH_PAGES,
+    ASYNC_CONCURRENCY,
+    ASYNC_HTTP_CONNECTIONS,
+    ASYNC_HTTP_TIMEOUT,
+)
+from rate_limit import (
+    SERVICE_SPOTIFY,
+    SERVICE_YANDEX,
+    THROTTLE_RETRIES,
+    RateLimiter,
+    parse_retry_after,
+    rate_limiters,
+    token_key,
+)
+from ya_music import MultipartFileStream, yandex_clients
+
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+YANDEX_API_URL = "https://api.music.yandex.net"
+# Потоки для базы и синхронных клиентов, в пределах пула соединений SQLAlchemy (5 + 10)
+BLOCKING_WORKERS = 8
+
+
+async def send_limited(
+        client: httpx.AsyncClient,
+        limiter: RateLimiter,
+        method: str,
+        url: str,
+        **kwargs,
+) -> httpx.Response:
+    """
+    Запрос через ограничитель частоты: ответ 429 повторяется после Retry-After.
+    :raises httpx.HTTPStatusError: сервис ответил ошибкой
+    """
+    # Потоковое тело (загрузка файла) уже отправлено, такой запрос не повторить
+    content = kwargs.get("content")
+    retries = THROTTLE_RETRIES if content is None or isinstance(content, (bytes, str)) else 0
+    for attempt in range(retries + 1):
+        await limiter.acquire_async()
+        response = await client.request(method, url, **kwargs)
+        if response.status_code != 429:
+            limiter.success()
+            break
+        limiter.throttle(parse_retry_after(response.headers.get("Retry-After")))
+    response.raise_for_status()
+    return response
+
+
+class AsyncSpotify:
+    """Spotify Web API с ключами приложения (client credentials), ответы совпадают со spotipy."""
+
+    def __init__(
+            self,
+            client_id: str,
+            client_secret: str,
+            limits: httpx.Limits,
+            transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.http = httpx.AsyncClient(
+            base_url=SPOTIFY_API_URL,
+            limits=limits,
+            timeout=ASYNC_HTTP_TIMEOUT,
+            transport=transport,
+        )
+        self.limiter = rate_limiters.get(SERVICE_SPOTIFY)
+        self._credentials = (client_id, client_secret)
+        self._token: str | None = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def _access_token(self) -> str:
+        async with self._token_lock:
+            if self._token is None or time.monotonic() >= self._token_expires_at:
+                response = await self.http.post(
+                    SPOTIFY_TOKEN_URL,
+                    data={"grant_type": "client_credentials"},
+                    auth=self._credentials,
+                )
+                response.raise_for_status()
+                data = response.json()
+                self._token = data["access_token"]
+                # Токен обновляется заранее, чтобы он не истёк между запросами страниц
+                self._token_expires_at = time.monotonic() + data["expires_in"] - 60
+            return self._token
+
+    async def get(self, path: str, **params) -> dict:
+        headers = {"Authorization": f"Bearer {await self._access_token()}"}
+        response = await send_limited(self.http, self.limiter, "GET", path, params=params, headers=headers)
+        return response.json()
+
+    async def get_album(self, _id: str, _type: str) -> dict:
+        """Альбом/плейлист по id через тот же кэш метаданных, что и logic.spotify_get_album."""
+        key = logic._album_cache_key(_id, _type)
+        album = await asyncio.to_thread(metadata_cache.get, key)
+        if album is not None:
+            return album
+        print(f"Получение spotify плейлиста/альбома по {_id=} {_type=}")
+        with metrics.timed("metadata"):
+            if _type == models.TaskTrackerAlbumType.album.value:
+                album = await self.get(f"/albums/{_id}")
+            elif _type == models.TaskTrackerAlbumType.playlist.value:
+                album = await self.get(f"/playlists/{_id}", additional_types="track")
+            elif _type == models.TaskTrackerAlbumType.track.value:
+                album = logic._track_as_album(await self.get(f"/tracks/{_id}"))
+            else:
+                raise TypeError("I'm not found type")
+        return await asyncio.to_thread(logic.cache_album, _id, _type, album)
+
+    async def get_album_tracks_page(self, _id: str, _type: str, offset: int) -> dict:
+        print(f"Получение страницы треков spotify плейлиста/альбома по {_id=} {_type=} {offset=}")
+        limit = logic.SPOTIFY_PAGE_LIMITS[_type]
+        with metrics.timed("metadata"):
+            if _type == models.TaskTrackerAlbumType.album.value:
+                return await self.get(f"/albums/{_id}/tracks", limit=limit, offset=offset)
+            if _type == models.TaskTrackerAlbumType.playlist.value:
+                return await self.get(f"/playlists/{_id}/tracks", limit=limit, offset=offset, additional_types="track")
+        if _type == models.TaskTrackerAlbumType.track.value:
+            return (await self.get_album(_id, _type))["tracks"]
+        raise TypeError("I'm not found type")
+
+    async def iter_album_tracks(
+            self,
+            _id: str,
+            _type: str,
+            first_page: dict | None = None,
+            prefetch: int = SPOTIFY_PREFETCH_PAGES,
+    ) -> AsyncIterator[list[str | None]]:
+        """Постранично отдаёт id треков, страницы после первой запрашиваются не больше prefetch наперёд."""
+        if first_page is None:
+            first_page = await self.get_album_tracks_page(_id, _type, offset=0)
+        yield logic._page_track_ids(first_page, _type)
+        pending = deque()
+        try:
+            for offset in logic.album_page_offsets(first_page, _type):
+                pending.append(asyncio.ensure_future(self.get_album_tracks_page(_id, _type, offset)))
+                if len(pending) >= prefetch:
+                    yield logic._page_track_ids(await pending.popleft(), _type)
+            while pending:
+                yield logic._page_track_ids(await pending.popleft(), _type)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+class AsyncYandexMusic:
+    """Загрузка треков и обложек в Яндекс Музыку для одного токена, как в YaMusicClient."""
+
+    def __init__(self, token: str, limits: httpx.Limits, transport: httpx.AsyncBaseTransport | None = None):
+        self.http = httpx.AsyncClient(
+            base_url=YANDEX_API_URL,
+            headers={**HEADERS, "User-Agent": USER_AGENT, "Authorization": f"OAuth {token}"},
+            limits=limits,
+            timeout=ASYNC_HTTP_TIMEOUT,
+            transport=transport,
+        )
+        self.limiter = rate_limiters.get(SERVICE_YANDEX, token_key(token))
+
+    @staticmethod
+    def _result(response: httpx.Response) -> Any:
+        # Те же имена полей, что у yandex_music: post-target -> post_target
+        data = json.loads(response.content, object_hook=Request._object_hook)
+        return data["result"] if data.get("result") is not None else data
+
+    async def _post_multipart(self, url: str, stream: MultipartFileStream) -> Any:
+        async def body() -> AsyncIterator[bytes]:
+            # Файл читается частями в потоке, чтобы не блокировать цикл событий
+            while chunk := await asyncio.to_thread(stream.read, stream.chunk_size):
+                yield chunk
+
+        response = await send_limited(
+            self.http, self.limiter, "POST", url,
+            content=body(),
+            headers={"Content-Type": stream.content_type, "Content-Length": str(len(stream))},
+        )
+        return self._result(response)
+
+    async def upload_track(self, path: Path, playlist_id: str) -> str:
+        owner_id, _ = playlist_id.split(":")
+        response = await send_limited(
+            self.http, self.limiter, "POST", "/loader/upload-url",
+            data={"uid": owner_id, "playlist-id": playlist_id, "path": path.name},
+        )
+        result = self._result(response)
+        with path.open("rb") as file:
+            await self._post_multipart(result["post_target"], MultipartFileStream("file", file, path.name))
+        return result["ugc_track_id"]
+
+    async def upload_cover(self, image: bytes, playlist_id: str) -> int:
+        owner_id, album_id = playlist_id.split(":")
+        url = f"/users/{owner_id}/playlists/{album_id}/cover/upload"
+        response = await self._post_multipart(url, MultipartFileStream("image", io.BytesIO(image), "cover.jpg"))
+        return response["uid"]
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def _claim_album(owner: str) -> models.TaskTrackerAlbum | None:
+    with queries.get_db() as db, metrics.timed("db"):
+        return queries.claim_album_not_completed(db=db, owner=owner, lease_seconds=TRANSFER_LEASE_SECONDS)
+
+
+def _claim_track(owner: str, per_user: int) -> models.TaskTrackerTrack | None:
+    with queries.get_db() as db, metrics.timed("db"):
+        return queries.claim_track_not_completed(
+            db=db,
+            owner=owner,
+            lease_seconds=TRANSFER_LEASE_SECONDS,
+            per_user=per_user,
+        )
+
+
+def _user_token(user_id: str) -> str | None:
+    with queries.get_db() as db:
+        return queries.get_or_create_user_model(db=db, user_id=user_id).yandex_access_token
+
+
+def _with_db(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Шаг переноса из logic в своей сессии: сессии не передаются между потоками пулов."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with queries.get_db() as db:
+            return func(db, *args, **kwargs)
+
+    return wrapper
+
+
+_skip_empty_track = _with_db(logic.skip_empty_track)
+_download_or_postpone = _with_db(logic.download_or_postpone)
+_complete_uploaded_track = _with_db(logic.complete_uploaded_track)
+_postpone_track = _with_db(logic.postpone_track)
+_postpone_album = _with_db(logic.postpone_album)
+
+
+class AsyncTransferEngine:
+    """
+    Переносит очередь за один проход: альбомы по одному, треки - concurrency корутинами.
+    :param downloaders: потоков для скачивания spotdl
+    :param per_user: максимум одновременных переносов на одного пользователя
+    :param concurrency: сколько треков в работе одновременно
+    :param transport: транспорт всех клиентов httpx, None - сеть (бенчмарк подставляет httpx.MockTransport)
+    """
+
+    def __init__(
+            self,
+            downloaders: int = TRANSFER_WORKERS,
+            per_user: int = TRANSFER_WORKERS_PER_USER,
+            concurrency: int = ASYNC_CONCURRENCY,
+            transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.per_user = per_user
+        self.concurrency = concurrency
+        self._transport = transport
+        self._limits = httpx.Limits(
+            max_connections=ASYNC_HTTP_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_CONNECTIONS,
+        )
+        self.spotify = AsyncSpotify(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, self._limits, transport)
+        self.images = httpx.AsyncClient(
+            limits=self._limits,
+            timeout=ASYNC_HTTP_TIMEOUT,
+            follow_redirects=True,
+            transport=transport,
+        )
+        self._yandex: dict[str, AsyncYandexMusic] = {}
+        self._downloads = ThreadPoolExecutor(max_workers=downloaders, thread_name_prefix="async-download")
+        self._blocking = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="async-blocking")
+
+    async def _run_blocking(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._blocking, functools.partial(func, *args, **kwargs))
+
+    def yandex(self, token: str) -> AsyncYandexMusic:
+        client = self._yandex.get(token)
+        if client is None:
+            client = self._yandex[token] = AsyncYandexMusic(token, self._limits, self._transport)
+        return client
+
+    async def run(self):
+        await self._run_blocking(logic.reclaim_expired_leases)
+        albums_done = asyncio.Event()
+        workers = [asyncio.create_task(self._track_worker(number, albums_done)) for number in range(self.concurrency)]
+        try:
+            await self._drain_albums()
+        finally:
+            albums_done.set()
+        await asyncio.gather(*workers)
+
+    async def aclose(self):
+        await self.spotify.aclose()
+        await self.images.aclose()
+        for client in self._yandex.values():
+            await client.aclose()
+        self._downloads.shutdown()
+        self._blocking.shutdown()
+
+    async def _drain_albums(self):
+        owner = f"{logic.worker_id()}:albums"
+        while True:
+            try:
+                task = await self._run_blocking(_claim_album, owner)
+                if task is None:
+                    return
+                lease = logic.LeaseKeeper(task=task, owner=owner).start()
+                try:
+                    await self.transfer_album(task)
+                except Exception as e:
+                    await self._run_blocking(_postpone_album, task, e)
+                    raise
+                finally:
+                    await self._run_blocking(lease.stop)
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    async def transfer_album(self, task: models.TaskTrackerAlbum):
+        """Шаги logic.transfer_album, но Spotify и обложка запрашиваются асинхронно."""
+        token = await self._run_blocking(_user_token, task.tg_id)
+        # Плейлист создаётся и треки ищутся в каталоге синхронным клиентом: это один-два запроса на страницу
+        yandex_client = await self._run_blocking(yandex_clients.checkout, token)
+        db = queries._session()
+        try:
+            album_info = await self.spotify.get_album(task.spotify_album_id, task.type)
+            await self._run_blocking(
+                logic.create_album_playlist, db=db, task=task, album_info=album_info, yandex_client=yandex_client,
+            )
+            # Обложка загружается параллельно с постановкой треков в очередь
+            cover_task = asyncio.create_task(self._upload_cover(task, album_info, self.yandex(token)))
+            try:
+                linker = logic.CatalogLinker(db=db, task=task, yandex_client=yandex_client)
+                pages = self.spotify.iter_album_tracks(
+                    task.spotify_album_id, task.type, first_page=album_info.get("tracks"),
+                )
+                async for tracks_ids in pages:
+                    await self._run_blocking(linker.enqueue_page, tracks_ids)
+                await self._run_blocking(linker.close)
+                cover_fingerprint = await cover_task
+            finally:
+                cover_task.cancel()
+            await self._run_blocking(
+                logic.complete_album, db=db, task=task, album_info=album_info, cover_fingerprint=cover_fingerprint,
+            )
+        finally:
+            yandex_clients.release(token)
+            await self._run_blocking(db.close)
+
+    async def _upload_cover(
+            self,
+            task: models.TaskTrackerAlbum,
+            album_info: dict,
+            yandex: AsyncYandexMusic,
+    ) -> str | None:
+        """Загружает обложку, если она ещё не загружена, и возвращает её отпечаток."""
+        image = cover.cover_to_upload(album_info.get("images"), task.cover_fingerprint)
+        if image is None:
+            return None
+        with metrics.timed("cover"):
+            response = await self.images.get(image["url"])
+            response.raise_for_status()
+            data = await asyncio.to_thread(cover.prepare_cover, image, response.content)
+            await yandex.upload_cover(data, task.yandex_music_album_id)
+        return image["url"]
+
+    async def _track_worker(self, number: int, albums_done: asyncio.Event):
+        owner = f"{logic.worker_id()}:{number}"
+        while True:
+            worked = None
+            try:
+                task = await self._run_blocking(_claim_track, owner, self.per_user)
+                if task is not None:
+                    lease = logic.LeaseKeeper(task=task, owner=owner).start()
+                    try:
+                        await self.transfer_track(task)
+                    finally:
+                        await self._run_blocking(lease.stop)
+                worked = task is not None
+            except Exception:
+                traceback.print_exc()
+            delay = await self._run_blocking(logic.track_worker_delay, worked, albums_done)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    async def transfer_track(self, task: models.TaskTrackerTrack):
+        """Шаги logic.transfer_track: spotdl в отдельном пуле, загрузка в Яндекс Музыку асинхронно."""
+        if await self._run_blocking(_skip_empty_track, task):
+            return
+        loop = asyncio.get_running_loop()
+        downloaded = await loop.run_in_executor(self._downloads, _download_or_postpone, task)
+        if downloaded is None:
+            return
+        song, path = downloaded
+        try:
+            token = await self._run_blocking(_user_token, task.tg_id)
+            with metrics.timed("upload"):
+                task.yandex_music_track_id = await self.yandex(token).upload_track(path, task.yandex_music_album_id)
+            await self._run_blocking(_complete_uploaded_track, task, song)
+        except Exception as e:
+            await self._run_blocking(_postpone_track, task, e)
+            raise
+        finally:
+            await self._run_blocking(logic.remove_downloaded_track, path)
+
+
+async def loop_async(
+        downloaders: int = TRANSFER_WORKERS,
+        per_user: int = TRANSFER_WORKERS_PER_USER,
+        concurrency: int = ASYNC_CONCURRENCY,
+        transport: httpx.AsyncBaseTransport | None = None,
+):
+    """Один проход очереди асинхронным движком, соединения закрываются в конце прохода."""
+    engine = AsyncTransferEngine(
+        downloaders=downloaders,
+        per_user=per_user,
+        concurrency=concurrency,
+        transport=transport,
+    )
+    try:
+        await engine.run()
+    finally:
+        await engine.aclose()
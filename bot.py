@@ -1,18 +1,92 @@
+import asyncio
+import functools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 
 from telegram import Update
-from telegram.ext import CommandHandler, CallbackContext, ApplicationBuilder
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackContext
 
+import importer
 import logic
 import queries
-from config import TG_BOT
+from config import TG_BOT, BOT_CONCURRENT_UPDATES, BOT_EXECUTOR_WORKERS, BOT_CALL_TIMEOUT, BOT_IMPORT_WORKERS
+from ya_music import yandex_clients
 
 # Логирование
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Как часто обновлять сообщение с прогрессом импорта
+IMPORT_PROGRESS_SECONDS = 3
+
+# Синхронные запросы к базе и Spotify выполняются здесь, а не в цикле событий бота
+_executor = ThreadPoolExecutor(max_workers=BOT_EXECUTOR_WORKERS, thread_name_prefix="bot")
+# Импорт идёт минутами, у него свой пул, чтобы не занимать потоки остальных команд
+_import_executor = ThreadPoolExecutor(max_workers=BOT_IMPORT_WORKERS, thread_name_prefix="bot-import")
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Выполняет синхронную функцию в пуле потоков бота.
+    Ожидание в очереди пула тоже входит в BOT_CALL_TIMEOUT, не начатый по таймауту вызов отменяется.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return await asyncio.wait_for(future, BOT_CALL_TIMEOUT)
+
+
+def reply_on_timeout(handler):
+    """Отвечает пользователю, если команда не уложилась в таймаут, вместо молчания."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext):
+        try:
+            return await handler(update, context)
+        except TimeoutError:
+            logger.warning("Команда %s не уложилась в %s с", update.message.text, BOT_CALL_TIMEOUT)
+            await update.message.reply_text("Сервис сейчас перегружен, попробуйте позже")
+
+    return wrapper
+
+
+def get_user_token(user_id: str) -> str | None:
+    with queries.get_db() as db:
+        user = queries.get_or_create_user_model(user_id=user_id, db=db)
+    return user.yandex_access_token
+
+
+def set_user_token(user_id: str, token: str):
+    with queries.get_db() as db:
+        user = queries.get_or_create_user_model(user_id=user_id, db=db)
+        # Клиент со старым токеном больше не нужен
+        yandex_clients.invalidate(user.yandex_access_token)
+        user.yandex_access_token = token
+        db.add(user)
+        db.commit()
+
+
+def get_list_relations(user_id: str, page: int) -> str:
+    with queries.get_db() as db:
+        return queries.get_list_relations_tracks(user_id=user_id, db=db, page=page)
+
+
+def get_failed_lines(user_id: str) -> list[str]:
+    with queries.get_db() as db:
+        albums = queries.get_failed_albums(db=db, user_id=user_id)
+        tracks = queries.get_failed_tracks(db=db, user_id=user_id)
+    return [
+        f"https://open.spotify.com/{album.type}/{album.spotify_album_id} ({album.attempts} попыток) {album.last_error or ''}"
+        for album in albums
+    ] + [
+        f"https://open.spotify.com/track/{track.spotify_track_id} ({track.attempts} попыток) {track.last_error or ''}"
+        for track in tracks
+    ]
+
 
 # Команда /set_yandex_token
+@reply_on_timeout
 async def set_yandex_token(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     token = context.args[0] if context.args else None
@@ -21,42 +95,59 @@ async def set_yandex_token(update: Update, context: CallbackContext):
         await update.message.reply_text("Пожалуйста, укажите токен. Пример: /set_yandex_token <токен>")
         return
 
-    with queries.get_db() as db:
-        user = queries.get_or_create_user_model(user_id=str(user_id), db=db)
-        user.yandex_access_token = token
-        db.add(user)
-        db.commit()
+    await run_blocking(set_user_token, str(user_id), token)
     await update.message.reply_text("Токен успешно установлен.")
 
 
 # Команда /list
+@reply_on_timeout
 async def list_tasks(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    with queries.get_db() as db:
-        user = queries.get_or_create_user_model(user_id=str(user_id), db=db)
-
-    if not user.yandex_access_token:
+    if not await run_blocking(get_user_token, str(user_id)):
         await update.message.reply_text("Токен не установлен. Используйте /set_yandex_token <токен>")
         return
 
-    with queries.get_db() as db:
-        relations = queries.get_list_relations_tracks(user_id=str(user_id), db=db)
+    page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    relations = await run_blocking(get_list_relations, str(user_id), max(page - 1, 0))
     await update.message.reply_text(relations or "Ещё ничего нет")
 
 
+# Команда /failed
+@reply_on_timeout
+async def list_failed(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    lines = await run_blocking(get_failed_lines, str(user_id))
+    if not lines:
+        await update.message.reply_text("Неперенесённых треков и альбомов нет")
+        return
+    lines.append("/retry вернёт их в очередь")
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+
+# Команда /retry
+@reply_on_timeout
+async def retry_failed(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    count = await run_blocking(logic.requeue_failed_tracks, user_id=str(user_id))
+    await update.message.reply_text(f"Возвращено в очередь треков и альбомов: {count}")
+
+
 # Команда /help
 async def help(update: Update, context: CallbackContext):
     await update.message.reply_text(
-        "/add добавляет новую задачу\n/list показывает 5 последних задач\n/set_yandex_token устанавливает токен"
+        "/add <ссылка> переносит альбом, плейлист или трек Spotify\n"
+        "/import <ссылки> переносит сразу много альбомов и плейлистов\n"
+        "/list [страница] показывает задачи по 5 на странице\n"
+        "/failed показывает треки и альбомы, которые не удалось перенести\n/retry возвращает их в очередь\n"
+        "/set_yandex_token устанавливает токен"
     )
 
 
 # Команда /add
+@reply_on_timeout
 async def add_album(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    with queries.get_db() as db:
-        user = queries.get_or_create_user_model(user_id=str(user_id), db=db)
-    token = user.yandex_access_token
+    token = await run_blocking(get_user_token, str(user_id))
     url = context.args[0] if context.args else None
 
     if not token:
@@ -64,28 +155,75 @@ async def add_album(update: Update, context: CallbackContext):
         return
 
     if not url:
-        await update.message.reply_text("Пожалуйста, укажите URL. Пример: /add <url>")
+        await update.message.reply_text("Пожалуйста, укажите ссылку на альбом, плейлист или трек. Пример: /add <url>")
         return
 
     try:
-        logic.add_task_album(user_id=str(user_id), url=url)
+        await run_blocking(logic.add_task_album, user_id=str(user_id), url=url)
         await update.message.reply_text("Создана задача на перенос треков")
+    except TimeoutError:
+        raise
     except Exception as err:
         await update.message.reply_text(f"Произошла ошибка задача {err}")
         raise
 
 
-# Основная функция
-def main():
-    # Укажите ваш токен Telegram-бота
-    app = ApplicationBuilder().token(TG_BOT).build()
+# Команда /import
+@reply_on_timeout
+async def import_albums(update: Update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    if not await run_blocking(get_user_token, str(user_id)):
+        await update.message.reply_text("Токен не установлен. Используйте /set_yandex_token <токен>")
+        return
+    if not context.args:
+        await update.message.reply_text(
+            "Пришлите ссылки через пробел или с новой строки: /import <url> <url> ...\n"
+            "Ссылка на профиль Spotify импортирует все его публичные плейлисты"
+        )
+        return
+
+    message = await update.message.reply_text("Импорт начат")
+    loop = asyncio.get_running_loop()
+
+    def run() -> importer.ImportProgress:
+        # Сообщение обновляется не чаще раза в IMPORT_PROGRESS_SECONDS, чтобы не упереться в лимиты Telegram
+        progress, reported_at = None, time.monotonic()
+        for progress in importer.import_albums(user_id=str(user_id), urls=context.args):
+            if time.monotonic() - reported_at >= IMPORT_PROGRESS_SECONDS:
+                reported_at = time.monotonic()
+                text = f"{progress.summary()}\n{progress.message}"
+                asyncio.run_coroutine_threadsafe(message.edit_text(text), loop)
+        return progress
+
+    # Импорт большого профиля идёт дольше BOT_CALL_TIMEOUT, поэтому без таймаута
+    progress = await loop.run_in_executor(_import_executor, run)
+    await message.edit_text(f"Импорт завершён. {progress.summary()}")
+
+
+def build_application(
+        builder: ApplicationBuilder,
+        concurrent_updates: int | bool = BOT_CONCURRENT_UPDATES,
+) -> Application:
+    """Собирает приложение с обработчиками команд, builder может подменить транспорт Telegram."""
+    # Без concurrent_updates обновления обрабатываются строго по одному
+    app = builder.concurrent_updates(concurrent_updates).build()
 
     # Регистрация команд
     app.add_handler(CommandHandler("set_yandex_token", set_yandex_token))
     app.add_handler(CommandHandler("list", list_tasks))
     app.add_handler(CommandHandler("add", add_album))
+    app.add_handler(CommandHandler("import", import_albums))
+    app.add_handler(CommandHandler("failed", list_failed))
+    app.add_handler(CommandHandler("retry", retry_failed))
     app.add_handler(CommandHandler("help", help))
     app.add_handler(CommandHandler("start", help))
+    return app
+
+
+# Основная функция
+def main():
+    # Укажите ваш токен Telegram-бота
+    app = build_application(ApplicationBuilder().token(TG_BOT))
 
     # Запуск бота
     app.run_polling()
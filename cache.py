@@ -0,0 +1,157 @@
+"""
+Кэш метаданных Spotify (альбомы, плейлисты, треки).
+
+В процессе держится LRU с TTL, за ним может стоять общее хранилище
+(SQLite файл или Redis), чтобы метаданные переживали перезапуск и делились между воркерами.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from config import METADATA_CACHE_URL, METADATA_CACHE_SIZE, METADATA_CACHE_TTL
+
+
+class SqliteCacheStore:
+    """Хранилище кэша в отдельном SQLite файле."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata_cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM metadata_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: int):
+        with self._lock:
+            now = time.time()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl),
+            )
+            self._connection.execute("DELETE FROM metadata_cache WHERE expires_at <= ?", (now,))
+            self._connection.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM metadata_cache WHERE key = ?", (key,))
+            self._connection.commit()
+
+
+class RedisCacheStore:
+    """Хранилище кэша в Redis, ключи истекают сами."""
+
+    def __init__(self, url: str, prefix: str = "spoty-to-yamusic:"):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key: str) -> Any | None:
+        value = self._redis.get(self._prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: int):
+        self._redis.set(self._prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, key: str):
+        self._redis.delete(self._prefix + key)
+
+
+def create_store(url: str | None) -> SqliteCacheStore | RedisCacheStore | None:
+    """
+    redis://host:port/db - Redis, sqlite:///path/to/cache.sqlite3 - SQLite файл, пусто - только память.
+    """
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCacheStore(url)
+    if url.startswith("sqlite:///"):
+        return SqliteCacheStore(url.removeprefix("sqlite:///"))
+    raise ValueError(f"Неизвестное хранилище кэша {url}")
+
+
+class MetadataCache:
+    """LRU кэш с TTL и ограничением размера поверх необязательного общего хранилища."""
+
+    def __init__(
+            self,
+            max_size: int = METADATA_CACHE_SIZE,
+            ttl: int = METADATA_CACHE_TTL,
+            store: SqliteCacheStore | RedisCacheStore | None = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+        value = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.store_hits += 1
+        self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        self._remember(key, value)
+        if self.store is not None:
+            self.store.set(key, value, self.ttl)
+
+    def delete(self, key: str):
+        """Забывает значение, например плейлист, который изменился в Spotify."""
+        with self._lock:
+            self._items.pop(key, None)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def _remember(self, key: str, value: Any):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get_or_set(self, key: str, factory: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
+
+
+metadata_cache = MetadataCache(store=create_store(METADATA_CACHE_URL))
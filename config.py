@@ -8,3 +8,104 @@ SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 YANDEX_MUSIC_TOKEN = os.getenv("YANDEX_MUSIC_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 TG_BOT = os.getenv("TG_BOT")
+
+# Количество параллельных воркеров переноса треков и ограничение на одного пользователя
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", "1"))
+TRANSFER_WORKERS_PER_USER = int(os.getenv("TRANSFER_WORKERS_PER_USER", "2"))
+# thread - потоки в одном процессе, process - отдельные процессы,
+# pipeline - отдельные стадии скачивания и загрузки, async - сетевые стадии в цикле событий asyncio
+TRANSFER_WORKERS_MODE = os.getenv("TRANSFER_WORKERS_MODE", "thread")
+# Время аренды задачи воркером, пока он её не продлит
+TRANSFER_LEASE_SECONDS = int(os.getenv("TRANSFER_LEASE_SECONDS", "600"))
+
+# Каталог для скачанных, но ещё не загруженных треков, и его ограничения
+STAGING_DIR = os.getenv("STAGING_DIR", "staging")
+STAGING_MAX_FILES = int(os.getenv("STAGING_MAX_FILES", "8"))
+STAGING_MAX_BYTES = int(os.getenv("STAGING_MAX_BYTES", str(512 * 1024 * 1024)))
+# Сколько байт резервируется под ещё не скачанный трек, после скачивания учитывается его настоящий размер
+STAGING_TRACK_ESTIMATE_BYTES = int(os.getenv("STAGING_TRACK_ESTIMATE_BYTES", str(16 * 1024 * 1024)))
+TRANSFER_UPLOADERS = int(os.getenv("TRANSFER_UPLOADERS", "2"))
+
+# Сколько страниц треков плейлиста запрашивать у Spotify параллельно
+SPOTIFY_PREFETCH_PAGES = int(os.getenv("SPOTIFY_PREFETCH_PAGES", "4"))
+
+# Кэш метаданных Spotify: redis://..., sqlite:///path или пусто (только память процесса)
+METADATA_CACHE_URL = os.getenv("METADATA_CACHE_URL", "")
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "1024"))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", str(60 * 60)))
+
+# Общее хранилище скачанных треков, пустой каталог отключает его
+TRACK_STORE_DIR = os.getenv("TRACK_STORE_DIR", "track_store")
+TRACK_STORE_QUOTA_BYTES = int(os.getenv("TRACK_STORE_QUOTA_BYTES", str(5 * 1024 * 1024 * 1024)))
+# Проверять sha256 файла при каждом попадании
+TRACK_STORE_VERIFY = os.getenv("TRACK_STORE_VERIFY", "1") == "1"
+
+# Через сколько секунд простоя клиент Яндекс.Музыки и его соединения закрываются
+YANDEX_CLIENT_IDLE_SECONDS = int(os.getenv("YANDEX_CLIENT_IDLE_SECONDS", str(10 * 60)))
+
+# Уведомления о новых задачах: postgres, redis://..., local или пусто (postgres для Postgres, иначе local)
+NOTIFY_URL = os.getenv("NOTIFY_URL", "")
+NOTIFY_LOCAL_PORT = int(os.getenv("NOTIFY_LOCAL_PORT", "47300"))
+# Сколько секунд воркер ждёт уведомления, прежде чем сам проверит очередь
+TASK_IDLE_TIMEOUT = int(os.getenv("TASK_IDLE_TIMEOUT", str(30 * 60)))
+
+# Задержка перед повтором неудачного трека: удваивается с каждой попыткой до максимума
+RETRY_BACKOFF_SECONDS = int(os.getenv("RETRY_BACKOFF_SECONDS", "60"))
+RETRY_BACKOFF_MAX_SECONDS = int(os.getenv("RETRY_BACKOFF_MAX_SECONDS", str(6 * 60 * 60)))
+# Сколько неудач подряд допускается, прежде чем трек попадёт в failed
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+
+# Бот: сколько обновлений обрабатывается одновременно, потоков для базы и Spotify и таймаут одного вызова
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+BOT_EXECUTOR_WORKERS = int(os.getenv("BOT_EXECUTOR_WORKERS", "8"))
+BOT_CALL_TIMEOUT = float(os.getenv("BOT_CALL_TIMEOUT", "30"))
+# Сколько /import бота выполняется одновременно, остальные ждут своей очереди
+BOT_IMPORT_WORKERS = int(os.getenv("BOT_IMPORT_WORKERS", "2"))
+
+# Импорт: сколько плейлистов запрашивается из Spotify одновременно и сколько задач пишется одной транзакцией
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "4"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50"))
+
+# Поиск трека в каталоге Яндекс Музыки перед скачиванием: 1 - включён, минимальная похожесть 0-100,
+# сколько поисковых запросов одновременно и через сколько дней повторять поиск не найденных треков
+CATALOG_MATCH = os.getenv("CATALOG_MATCH", "1") == "1"
+CATALOG_MATCH_MIN_SCORE = float(os.getenv("CATALOG_MATCH_MIN_SCORE", "85"))
+CATALOG_MATCH_CONCURRENCY = int(os.getenv("CATALOG_MATCH_CONCURRENCY", "4"))
+CATALOG_MATCH_MISS_DAYS = int(os.getenv("CATALOG_MATCH_MISS_DAYS", "30"))
+
+# Треки каталога добавляются в плейлист одним изменением на столько треков или раз в столько секунд
+PLAYLIST_BATCH_TRACKS = int(os.getenv("PLAYLIST_BATCH_TRACKS", "100"))
+PLAYLIST_BATCH_SECONDS = float(os.getenv("PLAYLIST_BATCH_SECONDS", "5"))
+
+# Ограничение частоты запросов: запросов в секунду и размер всплеска для приложения Spotify
+# и для каждого токена Яндекс Музыки. После 429 частота снижается и восстанавливается постепенно
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+SPOTIFY_RATE_BURST = int(os.getenv("SPOTIFY_RATE_BURST", "20"))
+YANDEX_RATE_LIMIT = float(os.getenv("YANDEX_RATE_LIMIT", "5"))
+YANDEX_RATE_BURST = int(os.getenv("YANDEX_RATE_BURST", "10"))
+# Дольше этого запрос не ждёт своей очереди и завершается ошибкой rate limit
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "60"))
+
+# Метрики воркера: адрес и порт HTTP /metrics (порт 0 - не запускать)
+# и как часто писать их сводку в лог строкой JSON (0 - не писать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_LOG_SECONDS = int(os.getenv("METRICS_LOG_SECONDS", "60"))
+
+# Асинхронный движок: сколько треков переносится одновременно, размер пула соединений
+# к каждому сервису и таймаут запроса в секундах
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", "16"))
+ASYNC_HTTP_CONNECTIONS = int(os.getenv("ASYNC_HTTP_CONNECTIONS", "20"))
+ASYNC_HTTP_TIMEOUT = float(os.getenv("ASYNC_HTTP_TIMEOUT", "30"))
+
+# Обложки: берётся самый маленький вариант Spotify со стороной не меньше COVER_MIN_SIZE,
+# изображения больше COVER_MAX_SIZE уменьшаются перед загрузкой (нужен Pillow)
+COVER_MIN_SIZE = int(os.getenv("COVER_MIN_SIZE", "300"))
+COVER_MAX_SIZE = int(os.getenv("COVER_MAX_SIZE", "1000"))
+
+# Синхронизация перенесённых плейлистов: раз в столько секунд у Spotify проверяется snapshot_id
+# (0 - не проверять), сколько плейлистов проверяется за проход и удалять ли из плейлиста Яндекс Музыки
+# треки, удалённые из плейлиста Spotify
+PLAYLIST_SYNC_SECONDS = int(os.getenv("PLAYLIST_SYNC_SECONDS", "0"))
+PLAYLIST_SYNC_BATCH = int(os.getenv("PLAYLIST_SYNC_BATCH", "100"))
+PLAYLIST_SYNC_REMOVALS = os.getenv("PLAYLIST_SYNC_REMOVALS", "0") == "1"
@@ -0,0 +1,70 @@
+"""
+Обложки плейлистов: выбор варианта изображения Spotify и уменьшение перед загрузкой.
+
+Spotify отдаёт обложку в нескольких размерах (обычно 640, 300 и 60 пикселей),
+URL варианта не меняется, пока не меняется сама картинка, поэтому он служит отпечатком обложки.
+Pillow необязателен: без него изображение загружается как есть.
+"""
+import io
+
+from config import COVER_MIN_SIZE, COVER_MAX_SIZE
+
+
+def _side(image: dict) -> int | None:
+    # У загруженных пользователем обложек плейлистов размеры не указаны
+    if image.get("width") is None or image.get("height") is None:
+        return None
+    return min(image["width"], image["height"])
+
+
+def pick_cover_image(images: list[dict], min_size: int = COVER_MIN_SIZE) -> dict | None:
+    """
+    Самый маленький вариант со стороной не меньше min_size.
+    Если таких нет, самый большой из известных, если размеры не указаны - первый.
+    """
+    if not images:
+        return None
+    sized = [image for image in images if _side(image) is not None]
+    if not sized:
+        return images[0]
+    large_enough = [image for image in sized if _side(image) >= min_size]
+    if large_enough:
+        return min(large_enough, key=_side)
+    return max(sized, key=_side)
+
+
+def cover_to_upload(images: list[dict] | None, fingerprint: str | None) -> dict | None:
+    """
+    Вариант обложки, который нужно загрузить в плейлист.
+    None, если изображений нет или этот вариант уже загружен (его URL совпадает с fingerprint).
+    """
+    image = pick_cover_image(images or [])
+    if image is None or image["url"] == fingerprint:
+        return None
+    return image
+
+
+def prepare_cover(image: dict, data: bytes) -> bytes:
+    """Содержимое обложки для загрузки: слишком большое или неизвестного размера изображение уменьшается."""
+    return fit_cover(data) if needs_resize(image) else data
+
+
+def needs_resize(image: dict, max_size: int = COVER_MAX_SIZE) -> bool:
+    if _side(image) is None:
+        return True
+    return max(image["width"], image["height"]) > max_size
+
+
+def fit_cover(data: bytes, max_size: int = COVER_MAX_SIZE) -> bytes:
+    """Уменьшает изображение до max_size по большей стороне, без Pillow возвращает как есть."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_size:
+            return data
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=90)
+    return output.getvalue()
@@ -0,0 +1,121 @@
+"""
+Массовый импорт: много ссылок на альбомы, плейлисты и треки или все публичные
+плейлисты пользователя Spotify за один запуск.
+
+Ссылки разбираются по мере чтения, метаданные запрашиваются параллельно
+(не больше concurrency запросов сразу), задачи пишутся пачками по batch_size.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+import logic
+import models
+import queries
+from config import IMPORT_CONCURRENCY, IMPORT_BATCH_SIZE
+from notify import notify_new_tasks
+from spotify_url import parse_spotify_url
+
+_ALBUM_TYPES = tuple(_type.value for _type in models.TaskTrackerAlbumType)
+
+
+@dataclass
+class ImportProgress:
+    resolved: int = 0
+    created: int = 0
+    existing: int = 0
+    failed: int = 0
+    # Последнее событие: название плейлиста или текст ошибки
+    message: str = ""
+
+    def summary(self) -> str:
+        return (
+            f"Найдено: {self.resolved}, новых задач: {self.created}, "
+            f"уже было: {self.existing}, ошибок: {self.failed}"
+        )
+
+
+def _iter_targets(urls: Iterable[str]) -> Iterator[tuple[str, str] | ValueError]:
+    """Пары (тип, id) по ссылкам, ссылка на пользователя раскрывается в его плейлисты."""
+    for url in urls:
+        url = url.strip()
+        if not url:
+            continue
+        try:
+            _type, _id = parse_spotify_url(url, types=(*_ALBUM_TYPES, "user"))
+        except ValueError as e:
+            yield e
+            continue
+        if _type != "user":
+            yield _type, _id
+            continue
+        try:
+            for page in logic.spotify_iter_user_playlists(_id):
+                for playlist_id in page:
+                    yield models.TaskTrackerAlbumType.playlist.value, playlist_id
+        except Exception as e:
+            yield ValueError(f"Не удалось получить плейлисты пользователя {_id}: {e}")
+
+
+def _resolve(_type: str, _id: str) -> tuple[str, str, str]:
+    """Проверяет, что объект есть в Spotify, и заодно кладёт его метаданные в кэш для воркера."""
+    album = logic.spotify_get_album(_id, _type)
+    return _type, album["id"], album.get("name") or _id
+
+
+def import_albums(
+        user_id: str,
+        urls: Iterable[str],
+        concurrency: int = IMPORT_CONCURRENCY,
+        batch_size: int = IMPORT_BATCH_SIZE,
+) -> Iterator[ImportProgress]:
+    """
+    Ставит в очередь перенос всего, на что ведут ссылки, и отдаёт прогресс после каждого объекта.
+    urls читаются лениво, поэтому их можно передавать прямо из файла.
+    """
+    progress = ImportProgress()
+    batch: list[tuple[str, str]] = []
+
+    def flush():
+        with queries.get_db() as db:
+            created = queries.get_or_create_albums(db=db, tg_id=user_id, albums=batch)
+        progress.created += created
+        progress.existing += len(batch) - created
+        batch.clear()
+        if created:
+            notify_new_tasks()
+
+    def collect(done: set[Future]) -> Iterator[ImportProgress]:
+        for future in done:
+            try:
+                _type, _id, name = future.result()
+            except Exception as e:
+                progress.failed += 1
+                progress.message = f"Ошибка: {e}"
+            else:
+                progress.resolved += 1
+                progress.message = f"{name} ({_type})"
+                batch.append((_type, _id))
+                if len(batch) >= batch_size:
+                    flush()
+            yield progress
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="import") as executor:
+        pending: set[Future] = set()
+        for target in _iter_targets(urls):
+            if isinstance(target, ValueError):
+                progress.failed += 1
+                progress.message = f"Ошибка: {target}"
+                yield progress
+                continue
+            pending.add(executor.submit(_resolve, *target))
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+    if batch:
+        flush()
+    progress.message = "Импорт завершён"
+    yield progress
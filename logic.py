@@ -5,29 +5,88 @@ https://yandex-music.readthedocs.io/en/latest/token.html
 https://developer.spotify.com
 
 """
+import asyncio
 import io
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, UTC
 from pathlib import Path
+from typing import BinaryIO, Iterator
 
 import requests
 from spotdl import Spotdl, Song
+from spotdl.utils.spotify import SpotifyClient
 from spotipy import Spotify, SpotifyClientCredentials
 from sqlalchemy.orm import Session
+from urllib3.util import Retry
 
+import cover
+import matcher
+import metrics
 import models
 import queries
-from config import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, YANDEX_MUSIC_TOKEN
-from ya_music import YaMusicClient
+from cache import metadata_cache
+from notify import notifier, notify_new_tasks
+from rate_limit import SERVICE_SPOTIFY, mount_rate_limit, rate_limiters
+from track_store import track_store
+from config import (
+    SPOTIFY_CLIENT_ID,
+    SPOTIFY_CLIENT_SECRET,
+    YANDEX_MUSIC_TOKEN,
+    TRANSFER_WORKERS,
+    TRANSFER_WORKERS_PER_USER,
+    TRANSFER_WORKERS_MODE,
+    TRANSFER_LEASE_SECONDS,
+    STAGING_DIR,
+    TRANSFER_UPLOADERS,
+    SPOTIFY_PREFETCH_PAGES,
+    TASK_IDLE_TIMEOUT,
+    CATALOG_MATCH,
+    PLAYLIST_SYNC_SECONDS,
+    PLAYLIST_SYNC_BATCH,
+    PLAYLIST_SYNC_REMOVALS,
+)
+from retry import TrackTransferError, classify_error, classify_message, is_exhausted, retry_delay
+from spotify_url import parse_spotify_url
+from ya_music import PlaylistInsertBatch, YaMusicClient, yandex_clients
+
+
+def spotify_session() -> requests.Session:
+    """
+    Сессия для запросов к Spotify API через общий ограничитель приложения.
+    Ошибки 5xx повторяются как в spotipy по умолчанию, 429 повторяет ограничитель.
+    """
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+    )
+    return mount_rate_limit(requests.Session(), rate_limiters.get(SERVICE_SPOTIFY), max_retries=retry)
+
 
 # Инициализация Spotify
 sp = Spotify(
     auth_manager=SpotifyClientCredentials(
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET
-    )
+    ),
+    requests_session=spotify_session(),
 )
 _spotdl = None
+_spotdl_lock = threading.Lock()
+# Обложки альбомов загружаются здесь, пока треки ставятся в очередь
+_cover_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cover")
 
 
 def get_spotdl() -> Spotdl:
@@ -35,80 +94,226 @@ def get_spotdl() -> Spotdl:
     # Инициализация spotdl
     if _spotdl is not None:
         return _spotdl
+    with _spotdl_lock:
+        # spotdl можно инициализировать только один раз на процесс
+        if _spotdl is None:
+            _spotdl = _create_spotdl()
+    return _spotdl
+
+
+def _create_spotdl() -> Spotdl:
     # Настройки для spotdl
     downloader_settings = {
         "format": "mp3",
         # Простой интерфейс для отображения прогресса
         "simple_tui": False,
+        # Скачиваем во временный каталог, файлы удаляются после загрузки
+        "output": str(Path(STAGING_DIR) / "{track-id}.{output-ext}"),
     }
 
-    _spotdl = Spotdl(
+    spotdl = Spotdl(
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         no_cache=True,
         headless=True,
         downloader_settings=downloader_settings,
     )
-
-    return _spotdl
+    # spotdl ходит в Spotify с теми же ключами приложения, поэтому и ограничитель у них общий
+    SpotifyClient()._session = spotify_session()
+    return spotdl
 
 
-def download_image(url: str) -> io.BytesIO:
+def download_image(url: str) -> BinaryIO:
     """
-    Скачивает изображение по URL и возвращает его как объект io.BytesIO.
+    Скачивает изображение по URL потоком во временный файл.
+    Небольшие изображения остаются в памяти, большие сбрасываются на диск.
 
     :param url: URL изображения.
-    :return: Объект io.BytesIO с содержимым изображения.
-    """
-    response = requests.get(url)
-    if response.status_code == 200:
-        # Создаем объект BytesIO и записываем в него данные
-        image_data = io.BytesIO(response.content)
-        image_data.seek(0)  # Перемещаем указатель в начало
-        return image_data
-    else:
-        raise Exception(f"Ошибка при загрузке изображения: {response.status_code}")
+    :return: Временный файл с содержимым изображения, его нужно закрыть.
+    """
+    with requests.get(url, stream=True) as response:
+        if response.status_code != 200:
+            raise Exception(f"Ошибка при загрузке изображения: {response.status_code}")
+        image_data = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            image_data.write(chunk)
+    image_data.seek(0)  # Перемещаем указатель в начало
+    return image_data
 
 
-def download_spotify_track(track_id: str) -> tuple[Song | None, Path | None]:
+def download_spotify_track(track_id: str) -> tuple[Song, Path]:
     """
     Скачивает трек из Spotify по ссылке.
 
     :param track_id: id трека на Spotify.
-    :return: Путь к скачанному файлу.
+    :return: Трек spotdl и путь к скачанному файлу.
+    :raises TrackTransferError: трек не удалось скачать, в kind класс ошибки для политики повторов.
     """
     track_url = f"https://open.spotify.com/track/{track_id}"
     spotdl = get_spotdl()
     try:
+        song = spotify_get_song(track_id)
+        # Трек мог уже скачать другой пользователь
+        path = track_store.get(track_id) if track_store is not None else None
+        if path is not None:
+            print(f"Трек взят из хранилища: {track_url}")
+            return song, path
         # Скачивание трека
         print(f"Скачивание трека: {track_url}")
-        song = spotdl.search([track_url])[0]
-        path = spotdl.download(song)
-        print(f"Трек успешно скачан: {track_url}")
-        return path
+        with metrics.timed("download"):
+            song, path = spotdl.download(song)
     except Exception as e:
         print(f"Ошибка при скачивании трека: {e}")
-        return None, None
+        raise TrackTransferError(classify_error(e), str(e)) from e
+    if path is None:
+        # spotdl не бросает исключение, а складывает текст ошибки в downloader.errors
+        message = _spotdl_error(spotdl, song) or "No results found"
+        print(f"Ошибка при скачивании трека: {message}")
+        raise TrackTransferError(classify_message(message), message)
+    if track_store is not None:
+        path = track_store.put(track_id, path)
+    print(f"Трек успешно скачан: {track_url}")
+    return song, path
+
+
+def _spotdl_error(spotdl: Spotdl, song: Song) -> str | None:
+    errors = getattr(spotdl.downloader, "errors", [])
+    return next((error for error in reversed(errors) if error.startswith(song.url)), None)
+
+
+def spotify_get_song(track_id: str) -> Song:
+    """Метаданные трека для spotdl, из кэша или через spotdl.search."""
+
+    def search() -> dict:
+        with metrics.timed("metadata"):
+            return get_spotdl().search([f"https://open.spotify.com/track/{track_id}"])[0].json
+
+    return Song.from_dict(metadata_cache.get_or_set(f"spotify:track:{track_id}", search))
+
+
+def _album_cache_key(_id: str, _type: str) -> str:
+    # spotify:track:<id> уже занят метаданными spotdl для трека
+    if _type == models.TaskTrackerAlbumType.track.value:
+        return f"spotify:single:{_id}"
+    return f"spotify:{_type}:{_id}"
+
+
+def _track_as_album(track: dict) -> dict:
+    """Трек в виде альбома из одного трека: название, обложка и первая страница треков."""
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "images": track["album"]["images"],
+        "tracks": {"items": [{"id": track["id"]}], "total": 1},
+    }
+
+
+def cache_album(_id: str, _type: str, album: dict) -> dict:
+    """Кладёт альбом/плейлист в кэш метаданных под id запроса и под его настоящим id."""
+    metadata_cache.set(_album_cache_key(_id, _type), album)
+    # Альбом мог быть запрошен по ссылке, дальше он запрашивается по id
+    if album["id"] != _id:
+        metadata_cache.set(_album_cache_key(album["id"], _type), album)
+    return album
 
 
 def spotify_get_album(_id: str, _type: str):
+    album = metadata_cache.get(_album_cache_key(_id, _type))
+    if album is not None:
+        return album
     print(f"Получение spotify плейлиста/альбома по {_id=} {_type=}")
+    with metrics.timed("metadata"):
+        if _type == models.TaskTrackerAlbumType.album.value:
+            album = sp.album(_id)
+        elif _type == models.TaskTrackerAlbumType.playlist.value:
+            album = sp.playlist(_id)
+        elif _type == models.TaskTrackerAlbumType.track.value:
+            album = _track_as_album(sp.track(_id))
+        else:
+            raise TypeError("I'm not found type")
+    return cache_album(_id, _type, album)
+
+
+# Максимальный размер страницы, который отдаёт Spotify API
+SPOTIFY_PAGE_LIMITS = {
+    models.TaskTrackerAlbumType.album.value: 50,
+    models.TaskTrackerAlbumType.playlist.value: 100,
+    models.TaskTrackerAlbumType.track.value: 1,
+}
+
+
+@metrics.timed("metadata")
+def spotify_get_album_tracks_page(_id: str, _type: str, offset: int) -> dict:
+    print(f"Получение страницы треков spotify плейлиста/альбома по {_id=} {_type=} {offset=}")
     if _type == models.TaskTrackerAlbumType.album.value:
-        return sp.album(_id)
+        return sp.album_tracks(_id, limit=SPOTIFY_PAGE_LIMITS[_type], offset=offset)
     if _type == models.TaskTrackerAlbumType.playlist.value:
-        return sp.playlist(_id)
+        return sp.playlist_items(_id, limit=SPOTIFY_PAGE_LIMITS[_type], offset=offset, additional_types=("track",))
+    if _type == models.TaskTrackerAlbumType.track.value:
+        return spotify_get_album(_id, _type)["tracks"]
     raise TypeError("I'm not found type")
 
 
-def spotify_get_album_tracks(_id: str, _type: str) -> list[str]:
-    print(f"Получение spotify плейлиста/альбома по {_id=} {_type=}")
-    if _type == models.TaskTrackerAlbumType.album.value:
-        tracks = sp.album_tracks(_id, limit=50, offset=0)
-        return [track['id'] for track in tracks['items']]
+def album_page_offsets(first_page: dict, _type: str) -> range:
+    """Смещения страниц треков после первой."""
+    return range(len(first_page["items"]), first_page["total"], SPOTIFY_PAGE_LIMITS[_type])
+
+
+def _page_track_ids(page: dict, _type: str) -> list[str | None]:
     if _type == models.TaskTrackerAlbumType.playlist.value:
-        tracks = sp.playlist_items(_id, limit=100, offset=0)
-        return [track["track"]['id'] for track in tracks['items']]
-    raise TypeError("I'm not found type")
+        # У удалённых треков и локальных файлов плейлиста track или id пустые
+        return [(item.get("track") or {}).get("id") for item in page["items"]]
+    return [track["id"] for track in page["items"]]
+
+
+def spotify_iter_album_tracks(
+        _id: str,
+        _type: str,
+        first_page: dict | None = None,
+        prefetch: int = SPOTIFY_PREFETCH_PAGES,
+) -> Iterator[list[str | None]]:
+    """
+    Постранично отдаёт id треков альбома/плейлиста.
+    После первой страницы известен total, поэтому следующие страницы
+    запрашиваются параллельно, но не больше prefetch наперёд.
+    :param first_page: уже полученная первая страница (например, из spotify_get_album)
+    :param prefetch: сколько страниц запрашивать наперёд
+    """
+    if first_page is None:
+        first_page = spotify_get_album_tracks_page(_id, _type, offset=0)
+    yield _page_track_ids(first_page, _type)
+    offsets = album_page_offsets(first_page, _type)
+    if not offsets:
+        return
+    with ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="spotify-page") as executor:
+        pending = deque()
+        for offset in offsets:
+            pending.append(executor.submit(spotify_get_album_tracks_page, _id, _type, offset))
+            if len(pending) >= prefetch:
+                yield _page_track_ids(pending.popleft().result(), _type)
+        while pending:
+            yield _page_track_ids(pending.popleft().result(), _type)
+
+
+def spotify_iter_user_playlists(user_id: str) -> Iterator[list[str]]:
+    """
+    Постранично отдаёт id публичных плейлистов пользователя Spotify.
+    Приватные плейлисты и сохранённые альбомы недоступны с ключами приложения без входа пользователя.
+    """
+    offset = 0
+    while True:
+        print(f"Получение страницы плейлистов spotify пользователя {user_id=} {offset=}")
+        page = sp.user_playlists(user_id, limit=50, offset=offset)
+        yield [playlist["id"] for playlist in page["items"] if playlist]
+        offset += len(page["items"])
+        if not page["items"] or offset >= page["total"]:
+            return
+
+
+@metrics.timed("metadata")
+def spotify_get_snapshot_id(playlist_id: str) -> str | None:
+    """Текущий snapshot_id плейлиста: один лёгкий запрос без треков, кэш не используется."""
+    return sp.playlist(playlist_id, fields="snapshot_id").get("snapshot_id")
 
 
 def from_album_to_spotify(db: Session) -> int:
@@ -117,77 +322,476 @@ def from_album_to_spotify(db: Session) -> int:
     :param db:
     :return:
     """
-    task = queries.get_albums_not_completed(db=db)
+    owner = worker_id()
+    with metrics.timed("db"):
+        task = queries.claim_album_not_completed(db=db, owner=owner, lease_seconds=TRANSFER_LEASE_SECONDS)
     if task is None:
         return 0
+    with LeaseKeeper(task=task, owner=owner):
+        try:
+            return transfer_album(db=db, task=task)
+        except Exception as e:
+            # Недоступный альбом откладывается, чтобы проход по очереди закончился, а не повторял его каждую секунду
+            postpone_album(db=db, task=task, error=e)
+            raise
+
+
+def transfer_album(db: Session, task: models.TaskTrackerAlbum) -> int:
+    """
+    Создаёт плейлист в yandex music и задачи на перенос треков альбома
+    :param db:
+    :param task: задача на перенос альбома
+    :return:
+    """
     user = queries.get_or_create_user_model(db=db, user_id=task.tg_id)
-    # Инициализация Яндекс.Музыки
-    yandex_client = YaMusicClient(user.yandex_access_token).init()
-    # Получает информацию об альбоме из Spotify
-    album_info = spotify_get_album(task.spotify_album_id, task.type)
-    if task.yandex_music_album_id is None:
-        playlist = yandex_client.users_playlists_create(
-            title=album_info["name"] or uuid.uuid4(),
-            visibility='public',
-        )  # Создаем плейлист в яндекс музыке
-        task.yandex_music_album_id = playlist.playlist_id
-        db.add(task)
-        db.commit()
-    # Скачиваем обложку альбома
-    cover_url = album_info['images'][0]['url']
-    yandex_client.upload_cover(
-        bytes_io=download_image(cover_url),
-        playlist_id=task.yandex_music_album_id,
-    )
-    tracks_ids = spotify_get_album_tracks(task.spotify_album_id, task.type)
-    for track_id in tracks_ids:
-        queries.get_or_create_track_by_params(
-            db=db,
-            tg_id=task.tg_id,
-            spotify_album_id=task.spotify_album_id,
-            spotify_track_id=track_id,
-            yandex_music_album_id=task.yandex_music_album_id,
+    # Инициализация Яндекс.Музыки, клиент не закрывается как простаивающий, пока альбом переносится
+    with yandex_clients.use(user.yandex_access_token) as yandex_client:
+        # Получает информацию об альбоме из Spotify
+        album_info = spotify_get_album(task.spotify_album_id, task.type)
+        create_album_playlist(db=db, task=task, album_info=album_info, yandex_client=yandex_client)
+        # Обложка загружается параллельно с постановкой треков в очередь
+        # Поток обложки получает значения, а не задачу: сессия задачи используется этим потоком
+        cover_future = _cover_executor.submit(
+            upload_album_cover, album_info, task.yandex_music_album_id, task.cover_fingerprint, yandex_client,
         )
+        # Каждая страница сразу ставится в очередь, весь плейлист в памяти не держим
+        pages = spotify_iter_album_tracks(task.spotify_album_id, task.type, first_page=album_info.get("tracks"))
+        linker = CatalogLinker(db=db, task=task, yandex_client=yandex_client)
+        for tracks_ids in pages:
+            linker.enqueue_page(tracks_ids)
+        linker.close()
+        # Ошибка обложки оставляет альбом незавершённым, как и раньше: при повторе треки уже в очереди
+        cover_fingerprint = cover_future.result()
+    complete_album(db=db, task=task, album_info=album_info, cover_fingerprint=cover_fingerprint)
+    return 1
+
+
+def create_album_playlist(db: Session, task: models.TaskTrackerAlbum, album_info: dict, yandex_client: YaMusicClient):
+    """Создаёт плейлист в yandex music, если его ещё нет у задачи."""
+    if task.yandex_music_album_id is not None:
+        return
+    playlist = yandex_client.users_playlists_create(
+        title=album_info["name"] or uuid.uuid4(),
+        visibility='public',
+    )  # Создаем плейлист в яндекс музыке
+    task.yandex_music_album_id = playlist.playlist_id
+    db.add(task)
+    db.commit()
+
+
+def upload_album_cover(
+        album_info: dict,
+        playlist_id: str,
+        fingerprint: str | None,
+        yandex_client: YaMusicClient,
+) -> str | None:
+    """
+    Загружает обложку в плейлист, если такая ещё не загружена.
+    :param fingerprint: отпечаток обложки, загруженной в плейлист раньше
+    :return: отпечаток загруженной обложки или None, если загружать нечего
+    """
+    image = cover.cover_to_upload(album_info.get("images"), fingerprint)
+    if image is None:
+        return None
+    with metrics.timed("cover"), download_image(image["url"]) as downloaded:
+        # В память изображение читается, только если его нужно уменьшить, иначе отправляется из временного файла
+        file = io.BytesIO(cover.fit_cover(downloaded.read())) if cover.needs_resize(image) else downloaded
+        yandex_client.upload_cover(file=file, playlist_id=playlist_id)
+    return image["url"]
+
+
+def complete_album(
+        db: Session,
+        task: models.TaskTrackerAlbum,
+        album_info: dict,
+        cover_fingerprint: str | None = None,
+):
+    """
+    Все треки альбома в очереди: задача на альбом завершена.
+    snapshot_id плейлиста запоминается, по нему синхронизация видит изменения.
+    :param cover_fingerprint: отпечаток загруженной обложки, None - обложка не загружалась
+    """
     task.completed = True
+    task.synced_at = datetime.now(UTC)
+    if album_info.get("snapshot_id") is not None:
+        task.spotify_snapshot_id = album_info["snapshot_id"]
+    task.cover_fingerprint = cover_fingerprint or task.cover_fingerprint
     db.add(task)
     db.commit()
+    metrics.albums_total.inc()
     print(f"Созданы задачи на перенос треков из альбома {task.spotify_album_id}")
-    return 1
 
 
-def from_track_to_spotify(db: Session):
+def remove_missing_tracks(
+        db: Session,
+        task: models.TaskTrackerAlbum,
+        track_ids: set[str],
+        yandex_client: YaMusicClient,
+        enabled: bool = PLAYLIST_SYNC_REMOVALS,
+) -> int:
+    """
+    Повторяет в yandex music удаления из плейлиста Spotify: треки, которых больше нет в плейлисте,
+    удаляются из плейлиста yandex music вместе с задачами.
+    Треки, которые сейчас переносит воркер, остаются до следующей синхронизации.
+    :param track_ids: все треки плейлиста в Spotify
+    :return: количество удалённых задач
+    """
+    if not enabled or task.type != models.TaskTrackerAlbumType.playlist.value:
+        return 0
+    with metrics.timed("db"):
+        removed = queries.get_removed_tracks(db=db, task=task, spotify_track_ids=track_ids)
+    if not removed:
+        return 0
+    uploaded = [track.yandex_music_track_id for track in removed if track.completed and track.yandex_music_track_id]
+    if uploaded:
+        with metrics.timed("link"):
+            yandex_client.users_playlists_delete_tracks(task.yandex_music_album_id, uploaded)
+    with metrics.timed("db"):
+        count = queries.delete_tracks(db=db, task=task, tracks=removed)
+    print(f"Из плейлиста {task.spotify_album_id} удалено треков: {count}")
+    return count
+
+
+class CatalogLinker:
+    """
+    Ставит треки альбома в очередь, а найденные в каталоге Яндекс Музыки
+    добавляет в плейлист пачками (PlaylistInsertBatch) без скачивания.
+    Задачи таких треков создаются уже завершёнными, когда пачка попала в плейлист.
+    После всех страниц close() повторяет удаления из плейлиста Spotify (remove_missing_tracks).
+    """
+
+    def __init__(self, db: Session, task: models.TaskTrackerAlbum, yandex_client: YaMusicClient):
+        self.db = db
+        self.task = task
+        self.yandex_client = yandex_client
+        self.enabled = CATALOG_MATCH
+        # Треки в пачке, ещё не добавленные в плейлист: {spotify id: id трека яндекс музыки}
+        self._linked: dict[str, str] = {}
+        self._batch = PlaylistInsertBatch(yandex_client, task.yandex_music_album_id)
+        self._batch.on_flush = self._enqueue_linked
+        self.matched = 0
+        # Все треки альбома в Spotify, по ним синхронизация находит удалённые
+        self.seen: set[str] = set()
+
+    def enqueue_page(self, tracks_ids: list[str | None]):
+        self.seen.update(track_id for track_id in tracks_ids if track_id is not None)
+        matches = self._match(tracks_ids) if self.enabled else {}
+        self._enqueue([track_id for track_id in tracks_ids if track_id not in matches])
+        for track_id, match in matches.items():
+            self._linked[track_id] = match.track_id
+            self._guard(self._batch.add, track_id, match.track_id, match.album_id)
+
+    def close(self):
+        self._guard(self._batch.flush)
+        print(f"Найдено в каталоге {self.matched} треков альбома {self.task.spotify_album_id}")
+        remove_missing_tracks(db=self.db, task=self.task, track_ids=self.seen, yandex_client=self.yandex_client)
+
+    def _match(self, tracks_ids: list[str | None]) -> dict[str, matcher.CatalogMatch]:
+        track_ids = [
+            track_id for track_id in dict.fromkeys(tracks_ids)
+            if track_id is not None and track_id not in self._linked
+        ]
+        existing = queries.get_existing_track_ids(
+            self.db, self.task.tg_id, self.task.spotify_album_id, track_ids, self.task.yandex_music_album_id,
+        )
+        track_ids = [track_id for track_id in track_ids if track_id not in existing]
+        if not track_ids:
+            return {}
+        try:
+            with metrics.timed("match"):
+                matches = matcher.match_tracks(db=self.db, spotify=sp, client=self.yandex_client, track_ids=track_ids)
+        except Exception as e:
+            self.db.rollback()
+            print(f"Поиск треков альбома {self.task.spotify_album_id} в каталоге не удался: {e}")
+            return {}
+        # Порядок треков как в альбоме
+        return {track_id: matches[track_id] for track_id in track_ids if track_id in matches}
+
+    def _guard(self, action, *args):
+        if self.enabled:
+            try:
+                with metrics.timed("link"):
+                    action(*args)
+                return
+            except Exception as e:
+                print(f"Ошибка добавления треков каталога в плейлист {self.task.yandex_music_album_id}: {e}")
+                self.enabled = False
+        # Треки, не попавшие в плейлист, переносятся обычным способом
+        fallback = list(self._linked)
+        self._linked.clear()
+        self._enqueue(fallback)
+
+    def _enqueue(self, tracks_ids: list[str | None], completed: dict[str, str] | None = None):
+        with metrics.timed("db"):
+            queries.get_or_create_tracks(
+                db=self.db,
+                tg_id=self.task.tg_id,
+                spotify_album_id=self.task.spotify_album_id,
+                spotify_track_ids=tracks_ids,
+                yandex_music_album_id=self.task.yandex_music_album_id,
+                completed=completed,
+            )
+
+    def _enqueue_linked(self, track_ids: list[str]):
+        completed = {track_id: self._linked.pop(track_id) for track_id in track_ids}
+        self._enqueue(track_ids, completed=completed)
+        self.matched += len(completed)
+        metrics.tracks_total.inc(len(completed), result="linked")
+
+
+def from_track_to_spotify(db: Session, per_user: int | None = None):
     """
     Функция переносит ID шники из спотифая в yandex music
     :param db:
+    :param per_user: максимум одновременных переносов на одного пользователя
     :return:
     """
-    task = queries.get_track_not_completed(db=db)
+    owner = worker_id()
+    with metrics.timed("db"):
+        task = queries.claim_track_not_completed(
+            db=db,
+            owner=owner,
+            lease_seconds=TRANSFER_LEASE_SECONDS,
+            per_user=per_user,
+        )
     if task is None:
         return 0
-    if task.spotify_track_id is None:
-        task.completed = True
-        db.add(task)
-        db.commit()
-        return None
-    song, path = download_spotify_track(track_id=task.spotify_track_id)
-    if path is None or song is None:
-        print(f"Произошла ошибка при загрузки трека на local из spotify {task.spotify_track_id}")
+    with LeaseKeeper(task=task, owner=owner):
+        return transfer_track(db=db, task=task)
+
+
+def transfer_track(db: Session, task: models.TaskTrackerTrack) -> int:
+    """
+    Скачивает трек из spotify и загружает его в yandex music
+    :param db:
+    :param task: задача на перенос трека
+    :return:
+    """
+    if skip_empty_track(db=db, task=task):
+        return 1
+    downloaded = download_or_postpone(db=db, task=task)
+    if downloaded is None:
         return 1
+    song, path = downloaded
+    try:
+        upload_downloaded_track(db=db, task=task, song=song, path=path)
+    except Exception as e:
+        postpone_track(db=db, task=task, error=e)
+        raise
+    finally:
+        remove_downloaded_track(path)
+    return 1
+
+
+def skip_empty_track(db: Session, task: models.TaskTrackerTrack) -> bool:
+    """Трек без id (локальный файл плейлиста) переносить нечего: задача сразу завершается."""
+    if task.spotify_track_id is not None:
+        return False
+    with metrics.timed("db"):
+        queries.complete_track(db=db, task=task)
+    return True
+
+
+def download_or_postpone(db: Session, task: models.TaskTrackerTrack) -> tuple[Song, Path] | None:
+    """Скачивает трек. Если скачать не удалось, откладывает его и возвращает None."""
+    try:
+        return download_spotify_track(track_id=task.spotify_track_id)
+    except TrackTransferError as e:
+        print(f"Произошла ошибка при загрузки трека на local из spotify {task.spotify_track_id}")
+        postpone_track(db=db, task=task, error=e)
+        return None
+
+
+def postpone_album(db: Session, task: models.TaskTrackerAlbum, error: BaseException):
+    """
+    Откладывает задачу на альбом после неудачной попытки по тем же правилам, что и треки:
+    задержка и число попыток зависят от класса ошибки, исчерпавшая попытки задача уходит в failed.
+    """
+    db.rollback()
+    kind = classify_error(error)
+    message = f"{kind}: {error}"
+    if is_exhausted(kind, task.attempts + 1):
+        with metrics.timed("db"):
+            queries.fail_album(db=db, task=task, error=message)
+        print(f"Альбом {task.spotify_album_id} перенесён в failed после {task.attempts} попыток: {message}")
+        return
+    delay = retry_delay(kind, task.attempts + 1)
+    with metrics.timed("db"):
+        queries.postpone_album(db=db, task=task, delay=delay, error=message)
+    print(f"Альбом {task.spotify_album_id} отложен на {delay}, неудачных попыток: {task.attempts}, {message}")
+
+
+def postpone_track(db: Session, task: models.TaskTrackerTrack, error: BaseException):
+    """
+    Откладывает трек после неудачной попытки, чтобы воркеры занимались остальными.
+    Задержка и число попыток зависят от класса ошибки, исчерпавший попытки трек уходит в failed.
+    """
+    db.rollback()
+    kind = classify_error(error)
+    message = f"{kind}: {error}"
+    if is_exhausted(kind, task.attempts + 1):
+        with metrics.timed("db"):
+            queries.fail_track(db=db, task=task, error=message)
+        metrics.tracks_total.inc(result="failed")
+        print(f"Трек {task.spotify_track_id} перенесён в failed после {task.attempts} попыток: {message}")
+        return
+    delay = retry_delay(kind, task.attempts + 1)
+    with metrics.timed("db"):
+        queries.postpone_track(db=db, task=task, delay=delay, error=message)
+    metrics.tracks_total.inc(result="retried")
+    print(f"Трек {task.spotify_track_id} отложен на {delay}, неудачных попыток: {task.attempts}, {message}")
+
+
+def upload_downloaded_track(db: Session, task: models.TaskTrackerTrack, song: Song, path: Path):
+    """
+    Загружает уже скачанный трек в yandex music и завершает задачу
+    :param db:
+    :param task: задача на перенос трека
+    :param song: трек spotdl
+    :param path: путь к скачанному файлу
+    """
     user = queries.get_or_create_user_model(db=db, user_id=task.tg_id)
     # Инициализация Яндекс.Музыки
-    yandex_client = YaMusicClient(user.yandex_access_token).init()
-    task.yandex_music_track_id = yandex_client.upload_track(
-        path=path,
-        playlist_id=task.yandex_music_album_id,
-    )
-    task.completed = True
-    db.add(task)
-    db.commit()
+    with yandex_clients.use(user.yandex_access_token) as yandex_client, metrics.timed("upload"):
+        task.yandex_music_track_id = yandex_client.upload_track(
+            path=path,
+            playlist_id=task.yandex_music_album_id,
+        )
+    complete_uploaded_track(db=db, task=task, song=song)
+
+
+def complete_uploaded_track(db: Session, task: models.TaskTrackerTrack, song: Song):
+    """Трек загружен, yandex_music_track_id у задачи уже заполнен."""
+    with metrics.timed("db"):
+        queries.complete_track(db=db, task=task)
+    metrics.tracks_total.inc(result="completed")
     print(f"Трек успешно загружен в яндекс музыку {song.name}")
-    return 1
+
+
+def remove_downloaded_track(path: Path):
+    """Удаляет скачанный файл после загрузки, чтобы не копить их на диске."""
+    if track_store is not None and track_store.contains(path):
+        # Файлы хранилища переиспользуются, их удаляет вытеснение по квоте
+        return
+    try:
+        path.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Не удалось удалить файл {path}: {e}")
+
+
+def worker_id() -> str:
+    """Идентификатор воркера, под которым он берёт задачи в аренду."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+class LeaseKeeper:
+    """
+    Продлевает аренду задачи в фоне, пока она обрабатывается, и снимает её в stop().
+    Можно использовать как контекстный менеджер.
+    """
+
+    def __init__(
+            self,
+            task: models.TaskTrackerAlbum | models.TaskTrackerTrack,
+            owner: str,
+            lease_seconds: int = TRANSFER_LEASE_SECONDS,
+    ):
+        self.task = task
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        # Продление и смена владельца не должны пересекаться
+        self._lock = threading.Lock()
+        self._renewer = threading.Thread(target=self._renew, name=f"lease-{task.id}", daemon=True)
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock, queries.get_db() as db:
+                if not queries.renew_lease(db=db, task=self.task, owner=self.owner, lease_seconds=self.lease_seconds):
+                    print(f"Аренда задачи {self.task.id} потеряна")
+                    return
+
+    def rename(self, owner: str) -> bool:
+        """Переписывает аренду на другого владельца, дальше она продлевается и снимается под ним."""
+        with self._lock, queries.get_db() as db:
+            if not queries.rename_lease(db=db, task=self.task, owner=self.owner, new_owner=owner):
+                return False
+            self.owner = owner
+            return True
+
+    def start(self) -> "LeaseKeeper":
+        self._renewer.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._renewer.join()
+        with queries.get_db() as db:
+            queries.release_lease(db=db, task=self.task, owner=self.owner)
+
+    def __enter__(self) -> "LeaseKeeper":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def sync_playlists(db: Session, interval: int = PLAYLIST_SYNC_SECONDS, limit: int = PLAYLIST_SYNC_BATCH) -> int:
+    """
+    Проверяет snapshot_id перенесённых плейлистов, которые не проверялись дольше interval секунд,
+    и возвращает изменившиеся в очередь. При повторном переносе уже известные треки пропускаются,
+    поэтому в очередь встают только новые.
+    :param interval: 0 - проверить все плейлисты
+    :param limit: сколько плейлистов проверить за вызов
+    :return: количество плейлистов, возвращённых в очередь
+    """
+    due_before = datetime.now(UTC) - timedelta(seconds=interval)
+    with metrics.timed("db"):
+        playlists = queries.get_playlists_to_sync(db=db, due_before=due_before, limit=limit)
+    changed = 0
+    for task in playlists:
+        if not queries.claim_playlist_sync(db=db, task=task, due_before=due_before):
+            continue
+        try:
+            snapshot_id = spotify_get_snapshot_id(task.spotify_album_id)
+        except Exception as e:
+            metrics.playlists_synced_total.inc(result="failed")
+            print(f"Не удалось проверить плейлист {task.spotify_album_id}: {e}")
+            continue
+        if snapshot_id == task.spotify_snapshot_id:
+            metrics.playlists_synced_total.inc(result="unchanged")
+            continue
+        # В кэше плейлист с прежними треками, перенос должен получить новый
+        metadata_cache.delete(_album_cache_key(task.spotify_album_id, task.type))
+        queries.reopen_album(db=db, task=task)
+        metrics.playlists_synced_total.inc(result="changed")
+        changed += 1
+        print(f"Плейлист {task.spotify_album_id} изменился в Spotify, возвращён в очередь")
+    if changed:
+        notify_new_tasks()
+    return changed
+
+
+def _sync_playlists():
+    if PLAYLIST_SYNC_SECONDS <= 0:
+        return
+    try:
+        with queries.get_db() as db:
+            sync_playlists(db=db)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+
+
+def reclaim_expired_leases():
+    with queries.get_db() as db:
+        reclaimed = queries.reclaim_expired_leases(db=db)
+    if reclaimed:
+        print(f"Сняты просроченные аренды: {reclaimed}")
 
 
 def loop():
+    reclaim_expired_leases()
     result = 1
     while result > 0:
         result = 0
@@ -203,25 +807,188 @@ def loop():
             time.sleep(1)
 
 
-def loop_forever():
-    while True:
-        loop()
-        time.sleep(5 * 60)
+def drain_albums():
+    """Обрабатывает задачи на альбомы, пока они не закончатся."""
+    result = 1
+    while result > 0:
+        try:
+            with queries.get_db() as db:
+                result = from_album_to_spotify(db=db)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            result = 1
+            time.sleep(1)
 
 
-def add_task_album(user_id: str, url: str):
-    for _type in models.TaskTrackerAlbumType:
+def has_tracks_not_completed() -> bool:
+    with queries.get_db() as db:
+        return queries.has_tracks_not_completed(db=db)
+
+
+# Пауза воркера треков, когда свободных треков нет или попытка упала
+WORKER_IDLE_SECONDS = 1
+
+
+def track_worker_delay(worked: bool | None, albums_done) -> float | None:
+    """
+    Что делать воркеру треков после попытки, одинаково во всех режимах.
+    :param worked: True - трек обработан, False - свободных треков нет, None - попытка упала
+    :param albums_done: событие (threading, multiprocessing или asyncio), выставленное после всех альбомов
+    :return: пауза перед следующей попыткой или None, если новых треков больше не будет и пора выходить
+    """
+    if worked:
+        return 0
+    if worked is False and albums_done.is_set() and not has_tracks_not_completed():
+        return None
+    return WORKER_IDLE_SECONDS
+
+
+def _track_worker(per_user: int, albums_done):
+    while True:
+        worked = None
         try:
-            album = spotify_get_album(url, _type.value)
             with queries.get_db() as db:
-                queries.get_or_create_album_by_params(
-                    db=db,
-                    tg_id=user_id,
-                    spotify_album_id=album["id"],
-                    type=_type.value,
-                )
-            return None
+                worked = from_track_to_spotify(db=db, per_user=per_user) > 0
         except Exception:
-            pass
+            import traceback
+            traceback.print_exc()
+        delay = track_worker_delay(worked, albums_done)
+        if delay is None:
+            return
+        time.sleep(delay)
+
+
+def _init_worker_process():
+    # Соединения, унаследованные от родительского процесса, использовать нельзя
+    queries._engine.dispose(close=False)
+    # Порт метрик занят родителем, метрики процесса видны только в логе
+    metrics.start(port=0)
+
+
+def loop_pool(
+        workers: int = TRANSFER_WORKERS,
+        per_user: int = TRANSFER_WORKERS_PER_USER,
+        mode: str = TRANSFER_WORKERS_MODE,
+):
+    """
+    Переносит треки пулом из нескольких потоков или процессов.
+    Альбомы обрабатываются в текущем потоке, треки - воркерами пула.
+    :param workers: количество воркеров
+    :param per_user: максимум одновременных переносов на одного пользователя
+    :param mode: thread или process
+    """
+    reclaim_expired_leases()
+    if mode == "process":
+        manager = multiprocessing.Manager()
+        albums_done = manager.Event()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker_process)
+    elif mode == "thread":
+        manager = None
+        albums_done = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="track-worker")
     else:
-        raise TypeError("Не найдено подходящего типа для ссылки")
+        raise ValueError(f"Неизвестный режим воркеров {mode}")
+    with executor:
+        for _ in range(workers):
+            executor.submit(_track_worker, per_user, albums_done)
+        drain_albums()
+        albums_done.set()
+    if manager is not None:
+        manager.shutdown()
+
+
+def loop_forever(
+        workers: int = TRANSFER_WORKERS,
+        per_user: int = TRANSFER_WORKERS_PER_USER,
+        mode: str = TRANSFER_WORKERS_MODE,
+        uploaders: int = TRANSFER_UPLOADERS,
+):
+    metrics.start()
+    # Подписываемся до первого прохода, чтобы не пропустить задачи, добавленные во время него
+    _listen_for_tasks()
+    while True:
+        _sync_playlists()
+        if mode == "pipeline":
+            from pipeline import loop_pipeline
+            loop_pipeline(downloaders=workers, uploaders=uploaders, per_user=per_user)
+        elif mode == "async":
+            from async_engine import loop_async
+            asyncio.run(loop_async(downloaders=workers, per_user=per_user))
+        elif workers > 1:
+            loop_pool(workers=workers, per_user=per_user, mode=mode)
+        else:
+            loop()
+        print(f"Кэш метаданных: {metadata_cache.stats()}")
+        if track_store is not None:
+            print(f"Хранилище треков: {track_store.stats()}")
+        _wait_for_tasks(_idle_timeout())
+
+
+def _idle_timeout() -> float:
+    """Ждём уведомления, но не дольше, чем до очереди ближайшей отложенной задачи или проверки плейлиста."""
+    try:
+        with queries.get_db() as db:
+            deadlines = [
+                queries.get_next_attempt_at(db=db),
+                queries.get_next_attempt_at(db=db, model=models.TaskTrackerAlbum),
+            ]
+            if PLAYLIST_SYNC_SECONDS > 0:
+                synced_at = queries.get_next_sync_at(db=db)
+                if synced_at is not None:
+                    deadlines.append(synced_at + timedelta(seconds=PLAYLIST_SYNC_SECONDS))
+    except Exception:
+        return TASK_IDLE_TIMEOUT
+    deadlines = [
+        deadline.replace(tzinfo=UTC) if deadline.tzinfo is None else deadline
+        for deadline in deadlines
+        if deadline is not None
+    ]
+    if not deadlines:
+        return TASK_IDLE_TIMEOUT
+    until = (min(deadlines) - datetime.now(UTC)).total_seconds()
+    return min(max(until, 1), TASK_IDLE_TIMEOUT)
+
+
+def _listen_for_tasks():
+    try:
+        notifier.listen()
+    except Exception as e:
+        print(f"Не удалось подписаться на уведомления о задачах: {e}")
+
+
+def _wait_for_tasks(timeout: float):
+    """Ждёт уведомления о новых задачах, но не дольше timeout."""
+    try:
+        if notifier.wait(timeout):
+            print("Получено уведомление о новых задачах")
+    except Exception as e:
+        print(f"Ошибка ожидания уведомлений, переходим на опрос: {e}")
+        time.sleep(min(timeout, 60))
+
+
+def add_task_album(user_id: str, url: str):
+    """
+    Ставит в очередь перенос альбома, плейлиста или трека по ссылке.
+    Тип и id берутся из самой ссылки, Spotify при этом не запрашивается.
+    :raises ValueError: ссылка не разобрана
+    """
+    _type, _id = parse_spotify_url(url)
+    with queries.get_db() as db:
+        queries.get_or_create_album_by_params(
+            db=db,
+            tg_id=user_id,
+            spotify_album_id=_id,
+            type=_type,
+        )
+    notify_new_tasks()
+
+
+def requeue_failed_tracks(user_id: str | None = None) -> int:
+    """Возвращает треки и альбомы из failed в очередь и будит воркеры."""
+    with queries.get_db() as db:
+        count = queries.requeue_failed_tracks(db=db, user_id=user_id)
+        count += queries.requeue_failed_albums(db=db, user_id=user_id)
+    if count:
+        notify_new_tasks()
+    return count
@@ -1,8 +1,17 @@
 import click
 from sqlalchemy import create_engine
 from models import Base  # Импортируйте Base из вашего модуля models
-from config import DATABASE_URL  # Импортируйте DATABASE_URL из config.py
-from logic import loop_forever, loop, add_task_album  # Импортируйте ваши функции
+from config import (
+    DATABASE_URL,
+    TRANSFER_WORKERS,
+    TRANSFER_WORKERS_PER_USER,
+    TRANSFER_WORKERS_MODE,
+    TRANSFER_UPLOADERS,
+    IMPORT_CONCURRENCY,
+    PLAYLIST_SYNC_SECONDS,
+    PLAYLIST_SYNC_BATCH,
+)
+from logic import loop_forever, loop, add_task_album, requeue_failed_tracks  # Импортируйте ваши функции
 
 # Создайте engine для базы данных
 _engine = create_engine(DATABASE_URL)
@@ -22,10 +31,151 @@ def init():
 
 
 @cli.command()
-def loop():
+def migrate():
+    """Добавляет в существующую базу недостающие таблицы и колонки."""
+    from queries import migrate as migrate_schema
+    for statement in migrate_schema(_engine):
+        click.echo(statement)
+    click.echo("Миграция базы данных завершена.")
+
+
+@cli.command()
+@click.option("--workers", default=TRANSFER_WORKERS, show_default=True, help="Количество воркеров переноса треков.")
+@click.option("--per-user", default=TRANSFER_WORKERS_PER_USER, show_default=True,
+              help="Максимум одновременных переносов на одного пользователя.")
+@click.option("--mode", default=TRANSFER_WORKERS_MODE, show_default=True,
+              type=click.Choice(["thread", "process", "pipeline", "async"]),
+              help="Воркеры в потоках, в отдельных процессах, конвейер скачивание/загрузка "
+                   "или асинхронный движок (workers - потоков скачивания).")
+@click.option("--uploaders", default=TRANSFER_UPLOADERS, show_default=True,
+              help="Количество потоков загрузки в режиме pipeline.")
+def loop(workers: int, per_user: int, mode: str, uploaders: int):
     """Запускает фоновую задачу loop_forever."""
-    click.echo("Запуск фоновой задачи loop_forever...")
-    loop_forever()
+    click.echo(f"Запуск фоновой задачи loop_forever ({workers=} {per_user=} {mode=})...")
+    loop_forever(workers=workers, per_user=per_user, mode=mode, uploaders=uploaders)
+
+
+@cli.command("import")
+@click.option("--user-id", required=True, help="Telegram id пользователя, для которого ставятся задачи.")
+@click.option("--file", "urls_file", type=click.File("r"), default=None,
+              help="Файл со ссылками, по одной на строку (- для stdin).")
+@click.option("--concurrency", default=IMPORT_CONCURRENCY, show_default=True,
+              help="Сколько плейлистов запрашивать из Spotify одновременно.")
+@click.argument("urls", nargs=-1)
+def import_urls(user_id: str, urls_file, concurrency: int, urls: tuple[str, ...]):
+    """
+    Ставит в очередь перенос всех альбомов, плейлистов и треков по ссылкам.
+    Ссылка на профиль Spotify (open.spotify.com/user/...) импортирует все его публичные плейлисты.
+    """
+    from itertools import chain
+    from importer import import_albums
+    progress = None
+    for progress in import_albums(user_id=user_id, urls=chain(urls, urls_file or ()), concurrency=concurrency):
+        click.echo(f"[{progress.resolved + progress.failed}] {progress.message}")
+    if progress is not None:
+        click.echo(progress.summary())
+
+
+@cli.command()
+@click.option("--user-id", default=None, help="Telegram id пользователя, по умолчанию все пользователи.")
+def requeue(user_id: str | None):
+    """Возвращает в очередь треки, исчерпавшие попытки переноса."""
+    count = requeue_failed_tracks(user_id=user_id)
+    click.echo(f"Возвращено в очередь треков: {count}")
+
+
+@cli.command()
+@click.option("--interval", default=PLAYLIST_SYNC_SECONDS, show_default=True,
+              help="Проверять плейлисты, не проверявшиеся дольше стольких секунд (0 - все).")
+@click.option("--limit", default=PLAYLIST_SYNC_BATCH, show_default=True, help="Сколько плейлистов проверить.")
+def sync(interval: int, limit: int):
+    """Проверяет перенесённые плейлисты в Spotify и возвращает изменившиеся в очередь."""
+    from logic import sync_playlists
+    from queries import get_db
+    with get_db() as db:
+        changed = sync_playlists(db=db, interval=interval, limit=limit)
+    click.echo(f"Плейлистов с изменениями: {changed}")
+
+
+@cli.command("bench-enqueue")
+@click.option("--database-url", default=DATABASE_URL, show_default=True, help="База для бенчмарка.")
+@click.option("--tracks", default=1000, show_default=True, help="Количество треков в альбоме.")
+def bench_enqueue(database_url: str, tracks: int):
+    """Сравнивает постановку треков в очередь по одному и пачкой."""
+    from bench import bench_enqueue as run
+    results = run(database_url=database_url, tracks=tracks)
+    for name, seconds, statements in results:
+        click.echo(f"{name:<20} {seconds:>8.3f}s {statements:>6} запросов")
+    timings = {name: seconds for name, seconds, _ in results}
+    click.echo(f"Ускорение вставки: x{timings['per_row_insert'] / timings['bulk_insert']:.1f}")
+
+
+@cli.command("bench-indexes")
+@click.option("--database-url", required=True, help="Пустая база для бенчмарка, все таблицы будут пересозданы.")
+@click.option("--rows", default=1_000_000, show_default=True, help="Количество треков в очереди.")
+def bench_indexes(database_url: str, rows: int):
+    """Сравнивает запросы воркера на старых одноколоночных и на составных индексах."""
+    from bench import bench_indexes as run
+    click.echo(f"{'запрос':<26} {'до, мс':>10} {'после, мс':>10}")
+    for name, (before, after) in run(database_url=database_url, rows=rows).items():
+        click.echo(f"{name:<26} {before:>10.2f} {after:>10.2f}")
+
+
+@cli.command("bench-bot")
+@click.option("--database-url", required=True, help="Отдельная база для бенчмарка, в неё пишутся задачи и пользователи.")
+@click.option("--updates", default=500, show_default=True, help="Количество одновременных обновлений.")
+def bench_bot(database_url: str, updates: int):
+    """Нагрузочный тест обработчиков бота через транспорт-заглушку Telegram."""
+    from bench import bench_bot as run
+    click.echo(f"{'режим':<10} {'p50, мс':>10} {'p99, мс':>10}")
+    for mode, (p50, p99) in run(database_url, updates=updates).items():
+        click.echo(f"{mode:<10} {p50:>10.1f} {p99:>10.1f}")
+
+
+@cli.command("bench-worker")
+@click.option("--database-url", required=True, help="Пустая база для бенчмарка, все таблицы будут пересозданы.")
+@click.option("--albums", default=10, show_default=True, help="Количество альбомов в очереди.")
+@click.option("--tracks-per-album", default=50, show_default=True, help="Количество треков в альбоме.")
+@click.option("--workers", default=4, show_default=True, help="Количество воркеров (потоков скачивания в pipeline).")
+@click.option("--per-user", default=TRANSFER_WORKERS_PER_USER, show_default=True,
+              help="Лимит одновременных переносов на пользователя, все альбомы бенчмарка у одного пользователя.")
+@click.option("--mode", default="thread", show_default=True,
+              type=click.Choice(["loop", "thread", "pipeline", "async"]),
+              help="Один поток, пул потоков, конвейер скачивание/загрузка или асинхронный движок.")
+@click.option("--spotify-latency", default=0.02, show_default=True, help="Задержка ответа Spotify, с.")
+@click.option("--download-latency", default=0.2, show_default=True, help="Время скачивания трека spotdl, с.")
+@click.option("--yandex-latency", default=0.05, show_default=True, help="Задержка ответа Яндекс Музыки, с.")
+@click.option("--download-error-rate", default=0.02, show_default=True, help="Доля треков, которые не скачиваются.")
+@click.option("--upload-error-rate", default=0.0, show_default=True, help="Доля загрузок с сетевой ошибкой.")
+@click.option("--catalog-rate", default=0.0, show_default=True, help="Доля треков, найденных в каталоге.")
+@click.option("--file-size", default=1024 * 1024, show_default=True, help="Размер скачанного файла, байт.")
+def bench_worker(
+        database_url: str,
+        albums: int,
+        tracks_per_album: int,
+        workers: int,
+        per_user: int,
+        mode: str,
+        **options,
+):
+    """Прогоняет очередь воркера на локальных заглушках Spotify, spotdl и Яндекс Музыки."""
+    from bench import FakeServices, bench_worker as run
+    result = run(
+        database_url,
+        albums=albums,
+        tracks_per_album=tracks_per_album,
+        workers=workers,
+        mode=mode,
+        options=FakeServices(**options),
+        per_user=per_user,
+    )
+    click.echo(f"Перенесено треков: {result['completed']}, отложено: {result['postponed']}, "
+               f"за {result['seconds']:.2f}s")
+    click.echo(f"Треков в секунду:      {result['tracks_per_second']:.2f}")
+    click.echo(f"SQL запросов на трек:  {result['statements_per_track']:.1f}")
+    click.echo(f"Пиковый RSS:           {result['peak_rss_mb']:.0f} МБ")
+    for stage, ms in sorted(result["stage_ms"].items()):
+        click.echo(f"  {stage:<10} {ms:>10.1f} мс в среднем")
 
 
 @cli.command()
@@ -0,0 +1,170 @@
+"""
+Поиск треков Spotify в каталоге Яндекс Музыки, чтобы добавлять их в плейлист
+напрямую, без скачивания и загрузки файла.
+
+Результаты хранятся в таблице track_match и общие для всех пользователей:
+трек, найденный однажды, больше не ищется. Запись с тем же ISRC
+(например, тот же трек из сборника) берётся из индекса без поиска.
+Сам поиск нечёткий: название, исполнители и длительность сравниваются через RapidFuzz.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+
+from rapidfuzz import fuzz, utils
+from spotipy import Spotify
+from sqlalchemy.orm import Session
+from yandex_music import Client, Track
+
+import queries
+from config import CATALOG_MATCH_MIN_SCORE, CATALOG_MATCH_CONCURRENCY, CATALOG_MATCH_MISS_DAYS
+
+# Столько треков отдаёт Spotify API за один запрос /tracks
+SPOTIFY_TRACKS_BATCH = 50
+# Сколько результатов поиска сравнивать
+SEARCH_RESULTS = 10
+# Разница длительности, при которой это точно другая запись
+DURATION_TOLERANCE_MS = 5000
+# Пометки в названии, которые по-разному пишут в Spotify и в Яндекс Музыке
+_TITLE_NOISE = re.compile(r"\s*[(\[][^)\]]*\b(feat|ft|with|remaster\w*)\b[^)\]]*[)\]]|\s+-\s+.*remaster\w*.*$", re.I)
+
+
+@dataclass
+class SpotifyTrackInfo:
+    id: str
+    isrc: str | None
+    title: str
+    artists: list[str]
+    duration_ms: int
+
+
+@dataclass
+class CatalogMatch:
+    track_id: str
+    album_id: str
+    score: float
+
+
+def _normalize_title(title: str) -> str:
+    return utils.default_process(_TITLE_NOISE.sub("", title))
+
+
+def score_candidate(info: SpotifyTrackInfo, candidate: Track) -> float:
+    """Похожесть трека каталога на трек Spotify от 0 до 100."""
+    if candidate.duration_ms and abs(candidate.duration_ms - info.duration_ms) > DURATION_TOLERANCE_MS:
+        return 0.0
+    title = candidate.title or ""
+    if candidate.version:
+        title = f"{title} ({candidate.version})"
+    title_score = fuzz.token_set_ratio(_normalize_title(info.title), _normalize_title(title))
+    candidate_artists = [artist.name for artist in candidate.artists or [] if artist.name]
+    artist_score = max(
+        (fuzz.token_set_ratio(artist, other, processor=utils.default_process)
+         for artist in info.artists for other in candidate_artists),
+        default=0.0,
+    )
+    return 0.6 * title_score + 0.4 * artist_score
+
+
+def search_catalog(
+        client: Client,
+        info: SpotifyTrackInfo,
+        min_score: float = CATALOG_MATCH_MIN_SCORE,
+) -> CatalogMatch | None:
+    """Лучший трек каталога для трека Spotify или None, если ничего достаточно похожего нет."""
+    query = f"{' '.join(info.artists[:2])} {_TITLE_NOISE.sub('', info.title)}"
+    result = client.search(query, type_="track", nocorrect=True)
+    if result is None or result.tracks is None:
+        return None
+    best = None
+    for candidate in result.tracks.results[:SEARCH_RESULTS]:
+        if not candidate.albums or candidate.available is False:
+            continue
+        score = score_candidate(info, candidate)
+        if score >= min_score and (best is None or score > best.score):
+            best = CatalogMatch(track_id=str(candidate.id), album_id=str(candidate.albums[0].id), score=score)
+    return best
+
+
+def spotify_get_tracks_info(spotify: Spotify, track_ids: list[str]) -> list[SpotifyTrackInfo]:
+    """Метаданные треков Spotify пачками по SPOTIFY_TRACKS_BATCH за запрос."""
+    infos = []
+    for offset in range(0, len(track_ids), SPOTIFY_TRACKS_BATCH):
+        for track in spotify.tracks(track_ids[offset:offset + SPOTIFY_TRACKS_BATCH])["tracks"]:
+            if not track:
+                continue
+            infos.append(SpotifyTrackInfo(
+                id=track["id"],
+                isrc=(track.get("external_ids") or {}).get("isrc"),
+                title=track["name"],
+                artists=[artist["name"] for artist in track["artists"]],
+                duration_ms=track["duration_ms"],
+            ))
+    return infos
+
+
+def match_tracks(
+        db: Session,
+        spotify: Spotify,
+        client: Client,
+        track_ids: list[str],
+        concurrency: int = CATALOG_MATCH_CONCURRENCY,
+) -> dict[str, CatalogMatch]:
+    """
+    Ищет треки в каталоге Яндекс Музыки: сначала в индексе по id и ISRC,
+    остальные через поиск, не больше concurrency запросов одновременно.
+    :return: {spotify id: найденный трек} только для найденных
+    """
+    miss_since = datetime.now(UTC) - timedelta(days=CATALOG_MATCH_MISS_DAYS)
+    known = queries.get_track_matches(db, track_ids, miss_since=miss_since)
+    matches = {
+        track_id: CatalogMatch(match.yandex_track_id, match.yandex_album_id, match.score)
+        for track_id, match in known.items()
+        if match.yandex_track_id is not None
+    }
+    unknown = [track_id for track_id in track_ids if track_id not in known]
+    if not unknown:
+        return matches
+    infos = spotify_get_tracks_info(spotify, unknown)
+    by_isrc = queries.get_track_matches_by_isrc(db, [info.isrc for info in infos if info.isrc])
+    found: dict[str, CatalogMatch | None] = {}
+    to_search = []
+    # Треки с одинаковым ISRC в одной пачке ищутся один раз
+    searched_isrc: dict[str, str] = {}
+    for info in infos:
+        match = by_isrc.get(info.isrc) if info.isrc else None
+        if match is not None:
+            found[info.id] = CatalogMatch(match.yandex_track_id, match.yandex_album_id, match.score)
+        elif info.isrc not in searched_isrc:
+            to_search.append(info)
+            if info.isrc:
+                searched_isrc[info.isrc] = info.id
+
+    def search(info: SpotifyTrackInfo) -> tuple[str, CatalogMatch | None] | None:
+        try:
+            return info.id, search_catalog(client, info)
+        except Exception as e:
+            # Ошибку поиска не запоминаем как промах, трек поищется в следующий раз
+            print(f"Ошибка поиска трека {info.id} в каталоге: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="catalog-search") as executor:
+        found.update(result for result in executor.map(search, to_search) if result is not None)
+    for info in infos:
+        first_id = searched_isrc.get(info.isrc) if info.isrc else None
+        if info.id not in found and first_id in found:
+            found[info.id] = found[first_id]
+    queries.save_track_matches(db, [
+        dict(
+            spotify_track_id=info.id,
+            isrc=info.isrc,
+            yandex_track_id=found[info.id].track_id if found[info.id] else None,
+            yandex_album_id=found[info.id].album_id if found[info.id] else None,
+            score=found[info.id].score if found[info.id] else None,
+        )
+        for info in infos
+        if info.id in found
+    ])
+    matches.update((track_id, match) for track_id, match in found.items() if match is not None)
+    return matches
@@ -0,0 +1,330 @@
+"""
+Метрики воркера переноса в формате Prometheus.
+
+Время стадий (metadata, match, link, download, upload, cover, db), счётчики треков,
+глубина очереди, попадания в кэш метаданных и хранилище треков,
+синхронизация плейлистов и ограничители частоты. Отдаются по HTTP на /metrics
+и раз в METRICS_LOG_SECONDS пишутся в лог одной строкой JSON.
+Метрики живут в памяти процесса: в режиме process у каждого дочернего процесса свои,
+их видно только в логе.
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator
+
+import queries
+from cache import metadata_cache
+from config import METRICS_HOST, METRICS_PORT, METRICS_LOG_SECONDS
+from rate_limit import rate_limiters
+from track_store import track_store
+
+# Границы гистограмм в секундах: от запроса к базе до скачивания длинного трека
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(labelnames, values), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _add(self, amount: float, labels: dict[str, str]):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> dict[tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        # Вызывается и в дочернем процессе после fork, где блокировка могла остаться захваченной
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self) -> dict[str, float]:
+        return {",".join(key) or "": value for key, value in sorted(self.collect().items())}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        self._add(amount, labels)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels: str):
+        self._add(amount, labels)
+
+    def dec(self, amount: float = 1, **labels: str):
+        self._add(-amount, labels)
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class CallbackMetric(_Metric):
+    """Значения считаются в момент сбора, например запросом к базе."""
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labelnames: tuple[str, ...],
+            collect: Callable[[], dict[tuple[str, ...], float]],
+            type: str = "gauge",
+    ):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self._collect = collect
+
+    def collect(self) -> dict[tuple[str, ...], float]:
+        try:
+            return self._collect()
+        except Exception as e:
+            print(f"Не удалось собрать метрику {self.name}: {e}")
+            return {}
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = (*sorted(buckets), math.inf)
+        # Метки: (счётчики по корзинам, сумма)
+        self._histograms: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._histograms.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._histograms[key] = (counts, total + value)
+
+    def reset(self):
+        super().reset()
+        self._histograms = {}
+
+    def _collect_histograms(self) -> dict[tuple[str, ...], tuple[list[int], float]]:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._histograms.items()}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, (counts, total) in sorted(self._collect_histograms().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        return {
+            ",".join(key): {"count": sum(counts), "sum": round(total, 3)}
+            for key, (counts, total) in sorted(self._collect_histograms().items())
+        }
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    "transfer_stage_seconds", "Время одной операции стадии переноса.", ("stage",),
+))
+stage_in_flight = registry.register(Gauge(
+    "transfer_stage_in_flight", "Операции стадии, которые выполняются сейчас.", ("stage",),
+))
+# completed - загружен, linked - добавлен из каталога, retried - отложен, failed - исчерпал попытки
+tracks_total = registry.register(Counter(
+    "transfer_tracks_total", "Треки по результату попытки переноса.", ("result",),
+))
+albums_total = registry.register(Counter(
+    "transfer_albums_total", "Альбомы и плейлисты, для которых созданы задачи на треки.",
+))
+# unchanged - snapshot_id тот же, changed - плейлист возвращён в очередь, failed - Spotify не ответил
+playlists_synced_total = registry.register(Counter(
+    "transfer_playlists_synced_total", "Проверки перенесённых плейлистов по результату.", ("result",),
+))
+
+
+def _queue_depth() -> dict[tuple[str, ...], float]:
+    with queries.get_db() as db:
+        return {(state,): count for state, count in queries.count_tracks_by_state(db).items()}
+
+
+def _rate_limit(field: str) -> Callable[[], dict[tuple[str, ...], float]]:
+    def collect():
+        return {(stats.name,): getattr(stats, field) for stats in rate_limiters.stats()}
+    return collect
+
+
+def _cache_requests() -> dict[tuple[str, ...], float]:
+    metadata = metadata_cache.stats()
+    values = {("metadata", result): metadata[key] for result, key in (
+        ("hit", "hits"), ("store_hit", "store_hits"), ("miss", "misses"),
+    )}
+    if track_store is not None:
+        store = track_store.stats()
+        values[("track_store", "hit")] = store["hits"]
+        values[("track_store", "miss")] = store["misses"]
+    return values
+
+
+registry.register(CallbackMetric(
+    "transfer_queue_tracks", "Незавершённые треки в очереди по состоянию.", ("state",), _queue_depth,
+))
+registry.register(CallbackMetric(
+    "rate_limit_rate", "Текущая частота ограничителя, запросов в секунду.", ("limiter",), _rate_limit("rate"),
+))
+registry.register(CallbackMetric(
+    "rate_limit_wait_seconds", "Сколько ждал бы запрос, отправленный сейчас.", ("limiter",), _rate_limit("wait"),
+))
+registry.register(CallbackMetric(
+    "rate_limit_throttled_total", "Ответы 429.", ("limiter",), _rate_limit("throttled"), type="counter",
+))
+registry.register(CallbackMetric(
+    "rate_limit_waited_seconds_total", "Суммарное ожидание в ограничителе.", ("limiter",),
+    _rate_limit("waited_seconds"), type="counter",
+))
+registry.register(CallbackMetric(
+    "cache_requests_total", "Обращения к кэшу метаданных Spotify и к хранилищу треков по результату.",
+    ("cache", "result"), _cache_requests, type="counter",
+))
+registry.register(CallbackMetric(
+    "metadata_cache_items", "Записи кэша метаданных в памяти процесса.", (),
+    lambda: {(): metadata_cache.stats()["size"]},
+))
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Замеряет время стадии, в том числе неудачной. Работает и как декоратор."""
+    stage_in_flight.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_in_flight.dec(stage=stage)
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы сборщика метрик в лог не пишем
+        pass
+
+
+def _log_forever(interval: float):
+    while True:
+        time.sleep(interval)
+        print(json.dumps({"event": "metrics", "ts": round(time.time(), 3), **registry.snapshot()}, ensure_ascii=False))
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _after_fork():
+    # Дочерний процесс (режим process) наследует флаг запуска и значения родителя, но не его потоки
+    global _started, _start_lock
+    _started = False
+    _start_lock = threading.Lock()
+    registry.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def start(host: str = METRICS_HOST, port: int = METRICS_PORT, log_seconds: int = METRICS_LOG_SECONDS):
+    """Запускает HTTP /metrics и запись сводки в лог в фоновых потоках, один раз на процесс."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    if port:
+        try:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            print(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        else:
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"Метрики доступны на http://{host}:{port}/metrics")
+    if log_seconds:
+        threading.Thread(target=_log_forever, args=(log_seconds,), name="metrics-log", daemon=True).start()
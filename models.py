@@ -3,7 +3,7 @@ import uuid
 from datetime import datetime, UTC
 from enum import Enum
 
-from sqlalchemy import UUID, func, VARCHAR, Boolean
+from sqlalchemy import UUID, func, VARCHAR, Boolean, Index, Integer, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, declared_attr
 
 
@@ -13,11 +13,12 @@ class Base(DeclarativeBase):
         primary_key=True,
         default=uuid.uuid4,
     )
-    created_at: Mapped[datetime] = mapped_column(default=datetime.now(UTC), server_default=func.now())
+    # Время берётся при каждой вставке/обновлении, а не один раз при импорте модуля
+    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(UTC), server_default=func.now())
 
     updated_at: Mapped[datetime] = mapped_column(
-        default=datetime.now(UTC),
-        onupdate=datetime.now(UTC),
+        default=lambda: datetime.now(UTC),
+        onupdate=lambda: datetime.now(UTC),
     )
     __name__: str  # type: ignore[misc]
 
@@ -31,25 +32,127 @@ class Base(DeclarativeBase):
 class TaskTrackerAlbumType(str, Enum):
     playlist = "playlist"
     album = "album"
+    # Отдельный трек переносится как альбом из одного трека
+    track = "track"
 
 
 class TaskTrackerAlbum(Base):
-    tg_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=False)
-    type: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
-    spotify_album_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
-    yandex_music_album_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
+    __table_args__ = (
+        # Очередь воркера: незавершённые задачи по времени следующей попытки
+        Index(
+            "ix_task_tracker_album_schedule",
+            "completed",
+            "next_attempt_at",
+            postgresql_where=text("completed IS false"),
+        ),
+        Index("ix_task_tracker_album_spotify_album_id_type", "spotify_album_id", "type"),
+        # /list: задачи пользователя по времени создания
+        Index("ix_task_tracker_album_tg_id_created_at", "tg_id", "created_at"),
+        # Синхронизация: перенесённые плейлисты по времени последней проверки
+        Index(
+            "ix_task_tracker_album_sync",
+            "type",
+            "synced_at",
+            postgresql_where=text("completed IS true"),
+        ),
+    )
+
+    tg_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=False)
+    type: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    spotify_album_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    yandex_music_album_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
     completed: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False)
+    # Аренда задачи воркером: кто взял и до какого момента
+    lease_owner: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    # Прогресс по трекам альбома, его увеличивают воркеры, чтобы /list не считал треки
+    tracks_total: Mapped[int] = mapped_column(Integer(), nullable=False, default=0, server_default=text("0"))
+    tracks_completed: Mapped[int] = mapped_column(Integer(), nullable=False, default=0, server_default=text("0"))
+    tracks_failed: Mapped[int] = mapped_column(Integer(), nullable=False, default=0, server_default=text("0"))
+    # Какая обложка уже загружена в плейлист (URL варианта Spotify), чтобы не загружать её повторно
+    cover_fingerprint: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    # Синхронизация плейлиста: snapshot_id Spotify, с которого перенесены треки, и время последней проверки
+    spotify_snapshot_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    synced_at: Mapped[datetime | None] = mapped_column(nullable=True, info={"backfill_from": "updated_at"})
+    # Неудачные попытки получить альбом из Spotify и время, раньше которого задача не берётся снова
+    attempts: Mapped[int] = mapped_column(Integer(), nullable=False, default=0, server_default=text("0"))
+    next_attempt_at: Mapped[datetime | None] = mapped_column(
+        nullable=True,
+        default=lambda: datetime.now(UTC),
+        info={"backfill_from": "created_at"},
+    )
+    # Задача исчерпала попытки и больше не берётся воркером, пока её не вернут в очередь
+    failed: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False, server_default=text("false"))
+    last_error: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
 
 
 class TaskTrackerTrack(Base):
-    tg_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=False)
-    spotify_album_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
-    spotify_track_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
-    yandex_music_album_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
-    yandex_music_track_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
+    __table_args__ = (
+        # Естественный ключ задачи: один трек альбома пользователя переносится один раз
+        Index(
+            "uq_task_tracker_track_natural_key",
+            "tg_id",
+            "spotify_album_id",
+            "spotify_track_id",
+            "yandex_music_album_id",
+            unique=True,
+        ),
+        # Очередь воркера: незавершённые треки по времени следующей попытки
+        Index(
+            "ix_task_tracker_track_schedule",
+            "completed",
+            "next_attempt_at",
+            postgresql_where=text("completed IS false"),
+        ),
+        # Активные аренды для лимита на пользователя: в индексе только взятые сейчас треки
+        Index(
+            "ix_task_tracker_track_leased",
+            "tg_id",
+            "lease_expires_at",
+            postgresql_where=text("lease_owner IS NOT NULL"),
+            sqlite_where=text("lease_owner IS NOT NULL"),
+        ),
+    )
+
+    # Запросы по tg_id и (tg_id, spotify_album_id) обслуживает префикс уникального ключа
+    tg_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=False)
+    spotify_album_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    spotify_track_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    yandex_music_album_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    yandex_music_track_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
     completed: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False)
+    lease_owner: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    # Неудачные попытки и время, раньше которого трек не берётся снова
+    attempts: Mapped[int] = mapped_column(Integer(), nullable=False, default=0, server_default=text("0"))
+    next_attempt_at: Mapped[datetime | None] = mapped_column(
+        nullable=True,
+        default=lambda: datetime.now(UTC),
+        info={"backfill_from": "created_at"},
+    )
+    # Трек исчерпал попытки и больше не берётся воркером, пока его не вернут в очередь
+    failed: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False, server_default=text("false"))
+    last_error: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
 
 
 class TaskUserInfo(Base):
     user_id: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=False)
-    yandex_access_token: Mapped[str | None] = mapped_column(VARCHAR(), index=True, nullable=True)
+    yandex_access_token: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+
+
+class TrackMatch(Base):
+    """
+    Общий для всех пользователей индекс: трек Spotify -> трек каталога Яндекс Музыки.
+    Промах (yandex_track_id пустой) тоже запоминается, чтобы не искать трек заново при каждом переносе.
+    """
+    __table_args__ = (
+        Index("uq_track_match_spotify_track_id", "spotify_track_id", unique=True),
+        # Одна и та же запись (ISRC) встречается в разных альбомах и сборниках
+        Index("ix_track_match_isrc", "isrc"),
+    )
+
+    spotify_track_id: Mapped[str] = mapped_column(VARCHAR(), nullable=False)
+    isrc: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    yandex_track_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    yandex_album_id: Mapped[str | None] = mapped_column(VARCHAR(), nullable=True)
+    score: Mapped[float | None] = mapped_column(nullable=True)
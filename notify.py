@@ -0,0 +1,176 @@
+"""
+Уведомления воркеру о новых задачах, чтобы не ждать следующего прохода по таймеру.
+
+Бэкенды:
+    postgres - LISTEN/NOTIFY в той же базе (по умолчанию, если база Postgres)
+    redis://host:port/db - канал Redis pub/sub
+    local - UDP broadcast на loopback, для SQLite и процессов на одной машине
+"""
+import select
+import socket
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from config import DATABASE_URL, NOTIFY_URL, NOTIFY_LOCAL_PORT
+
+CHANNEL = "spoty_to_yamusic_tasks"
+
+
+class LocalNotifier:
+
+    def __init__(self, port: int = NOTIFY_LOCAL_PORT):
+        # Широковещательный адрес loopback: датаграмму получат все слушатели на машине
+        self.address = ("127.255.255.255", port)
+        self._listener: socket.socket | None = None
+
+    def listen(self):
+        if self._listener is not None:
+            return
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.setblocking(False)
+        self._listener = listener
+
+    def publish(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sender.sendto(b"1", self.address)
+
+    def wait(self, timeout: float) -> bool:
+        self.listen()
+        ready, _, _ = select.select([self._listener], [], [], timeout)
+        if not ready:
+            return False
+        # Несколько уведомлений подряд будят воркер один раз
+        while True:
+            try:
+                self._listener.recv(16)
+            except BlockingIOError:
+                return True
+
+
+class RedisNotifier:
+
+    def __init__(self, url: str):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._pubsub = None
+
+    def listen(self):
+        if self._pubsub is None:
+            self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(CHANNEL)
+
+    def publish(self):
+        self._redis.publish(CHANNEL, "1")
+
+    def wait(self, timeout: float) -> bool:
+        self.listen()
+        if self._pubsub.get_message(timeout=timeout) is None:
+            return False
+        while self._pubsub.get_message(timeout=0) is not None:
+            pass
+        return True
+
+
+class PostgresNotifier:
+    # Пауза перед повторным LISTEN после обрыва соединения, удваивается до RECONNECT_MAX_SECONDS
+    RECONNECT_SECONDS = 1
+    RECONNECT_MAX_SECONDS = 60
+
+    def __init__(self, engine: Engine):
+        self._engine = engine
+        self._connection = None
+        self._reconnect_delay = self.RECONNECT_SECONDS
+        # Соединение обрывалось: уведомления за это время потеряны
+        self._lost = False
+
+    def listen(self):
+        if self._connection is not None:
+            return
+        connection = self._engine.raw_connection()
+        try:
+            connection.driver_connection.autocommit = True
+            connection.driver_connection.cursor().execute(f"LISTEN {CHANNEL}")
+        except Exception:
+            connection.invalidate()
+            raise
+        self._connection = connection
+
+    def _drop(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            # Соединение не возвращается в пул: оно либо оборвано, либо подписано на канал
+            connection.invalidate()
+        except Exception:
+            pass
+
+    def publish(self):
+        with self._engine.begin() as connection:
+            connection.execute(text("SELECT pg_notify(:channel, '')"), {"channel": CHANNEL})
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Ждёт уведомления не дольше timeout. Оборванное соединение переподключается
+        с нарастающей паузой, а после переподключения воркер будится, чтобы проверить пропущенные задачи.
+        """
+        try:
+            self.listen()
+            received = self._wait(timeout)
+        except Exception as e:
+            self._drop()
+            self._lost = True
+            delay = min(self._reconnect_delay, timeout)
+            print(f"Соединение LISTEN потеряно, переподключение через {delay:.0f}s: {e}")
+            time.sleep(delay)
+            self._reconnect_delay = min(self._reconnect_delay * 2, self.RECONNECT_MAX_SECONDS)
+            return False
+        self._reconnect_delay = self.RECONNECT_SECONDS
+        if self._lost:
+            self._lost = False
+            return True
+        return received
+
+    def _wait(self, timeout: float) -> bool:
+        connection = self._connection.driver_connection
+        if hasattr(connection, "poll"):
+            # psycopg2
+            ready, _, _ = select.select([connection], [], [], timeout)
+            if not ready:
+                return False
+            connection.poll()
+            received = bool(connection.notifies)
+            connection.notifies.clear()
+            return received
+        # psycopg 3
+        return any(True for _ in connection.notifies(timeout=timeout, stop_after=1))
+
+
+def create_notifier(url: str | None = NOTIFY_URL, engine: Engine | None = None):
+    if not url:
+        url = "postgres" if DATABASE_URL and DATABASE_URL.startswith("postgres") else "local"
+    if url == "postgres":
+        if engine is None:
+            from queries import _engine as engine
+        return PostgresNotifier(engine)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisNotifier(url)
+    if url == "local":
+        return LocalNotifier()
+    raise ValueError(f"Неизвестный бэкенд уведомлений {url}")
+
+
+notifier = create_notifier()
+
+
+def notify_new_tasks():
+    """Будит воркеры. Ошибка уведомления не должна ломать постановку задачи."""
+    try:
+        notifier.publish()
+    except Exception as e:
+        print(f"Не удалось отправить уведомление о новых задачах: {e}")
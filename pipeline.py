@@ -0,0 +1,213 @@
+"""
+Конвейер переноса треков: стадия скачивания заполняет ограниченный каталог
+скачанными треками заранее, стадия загрузки выгружает их в yandex music.
+"""
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+from spotdl import Song
+
+import logic
+import metrics
+import models
+import queries
+from config import (
+    STAGING_MAX_FILES,
+    STAGING_MAX_BYTES,
+    STAGING_TRACK_ESTIMATE_BYTES,
+    TRANSFER_LEASE_SECONDS,
+    TRANSFER_UPLOADERS,
+    TRANSFER_WORKERS,
+    TRANSFER_WORKERS_PER_USER,
+)
+
+
+@dataclass
+class StagedTrack:
+    task_id: uuid.UUID
+    song: Song
+    path: Path
+    size: int
+    lease: logic.LeaseKeeper
+
+
+class StagingBuffer:
+    """
+    Ограниченный буфер скачанных треков.
+
+    Перед скачиванием место резервируется через reserve(): оно блокируется,
+    пока в буфере не меньше max_files файлов или резерв ещё одного трека превысил бы max_bytes.
+    Под скачиваемый трек резервируется estimate байт, put() заменяет оценку настоящим размером файла.
+    После загрузки release() удаляет файл и освобождает место.
+    """
+
+    def __init__(
+            self,
+            max_files: int = STAGING_MAX_FILES,
+            max_bytes: int = STAGING_MAX_BYTES,
+            estimate: int = STAGING_TRACK_ESTIMATE_BYTES,
+    ):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.estimate = estimate
+        self._cond = threading.Condition()
+        self._queue: deque[StagedTrack] = deque()
+        # Файлы в очереди, на загрузке и зарезервированные под скачивание, и их байты (для скачиваемых - оценка)
+        self._files = 0
+        self._bytes = 0
+        self._closed = False
+
+    def _has_room(self) -> bool:
+        if self._files >= self.max_files:
+            return False
+        # Пустой буфер всегда принимает трек, даже если оценка больше max_bytes
+        return self._files == 0 or self._bytes + self.estimate <= self.max_bytes
+
+    def reserve(self) -> bool:
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or self._has_room())
+            if self._closed:
+                return False
+            self._files += 1
+            self._bytes += self.estimate
+            return True
+
+    def cancel(self):
+        with self._cond:
+            self._files -= 1
+            self._bytes -= self.estimate
+            self._cond.notify_all()
+
+    def put(self, staged: StagedTrack):
+        with self._cond:
+            self._bytes += staged.size - self.estimate
+            self._queue.append(staged)
+            self._cond.notify_all()
+
+    def get(self) -> StagedTrack | None:
+        """Возвращает следующий трек или None, если буфер закрыт и пуст."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._queue or self._closed)
+            if self._queue:
+                return self._queue.popleft()
+            return None
+
+    def release(self, staged: StagedTrack):
+        logic.remove_downloaded_track(staged.path)
+        with self._cond:
+            self._files -= 1
+            self._bytes -= staged.size
+            self._cond.notify_all()
+
+    def close(self):
+        """Новые треки больше не поступят: загрузчики дочищают очередь и выходят."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def _download_next(per_user: int) -> tuple[int, StagedTrack | None]:
+    owner = logic.worker_id()
+    with queries.get_db() as db:
+        with metrics.timed("db"):
+            task = queries.claim_track_not_completed(
+                db=db,
+                owner=owner,
+                lease_seconds=TRANSFER_LEASE_SECONDS,
+                per_user=per_user,
+            )
+        if task is None:
+            return 0, None
+        staged = None
+        lease = logic.LeaseKeeper(task=task, owner=owner).start()
+        try:
+            if logic.skip_empty_track(db=db, task=task):
+                return 1, None
+            downloaded = logic.download_or_postpone(db=db, task=task)
+            if downloaded is None:
+                return 1, None
+            song, path = downloaded
+            # Скачанный трек ждёт загрузки и не занимает место в лимите на пользователя,
+            # иначе вперёд скачивалось бы не больше per_user треков пользователя
+            if not lease.rename(owner + queries.STAGED_LEASE_SUFFIX):
+                print(f"Аренда трека {task.spotify_track_id} потеряна, скачанный файл не загружается")
+                logic.remove_downloaded_track(path)
+                return 1, None
+            staged = StagedTrack(task_id=task.id, song=song, path=path, size=path.stat().st_size, lease=lease)
+            return 1, staged
+        finally:
+            # Аренда остаётся за скачанным треком, пока его не загрузит стадия загрузки
+            if staged is None:
+                lease.stop()
+
+
+def _download_stage(buffer: StagingBuffer, per_user: int, albums_done: threading.Event):
+    while buffer.reserve():
+        worked, staged = None, None
+        try:
+            result, staged = _download_next(per_user=per_user)
+            worked = result > 0
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        if staged is not None:
+            buffer.put(staged)
+            continue
+        buffer.cancel()
+        delay = logic.track_worker_delay(worked, albums_done)
+        if delay is None:
+            return
+        time.sleep(delay)
+
+
+def _upload_stage(buffer: StagingBuffer):
+    while (staged := buffer.get()) is not None:
+        try:
+            with queries.get_db() as db:
+                task = db.get(models.TaskTrackerTrack, staged.task_id)
+                try:
+                    logic.upload_downloaded_track(db=db, task=task, song=staged.song, path=staged.path)
+                except Exception as e:
+                    logic.postpone_track(db=db, task=task, error=e)
+                    raise
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        finally:
+            staged.lease.stop()
+            buffer.release(staged)
+
+
+def loop_pipeline(
+        downloaders: int = TRANSFER_WORKERS,
+        uploaders: int = TRANSFER_UPLOADERS,
+        per_user: int = TRANSFER_WORKERS_PER_USER,
+        buffer: StagingBuffer | None = None,
+):
+    """
+    Переносит треки конвейером: скачивание и загрузка идут параллельно.
+    :param downloaders: количество потоков скачивания
+    :param uploaders: количество потоков загрузки
+    :param per_user: максимум одновременных скачиваний на одного пользователя,
+        скачанные треки в буфере в него не входят
+    :param buffer: буфер скачанных треков
+    """
+    buffer = buffer or StagingBuffer()
+    albums_done = threading.Event()
+    logic.reclaim_expired_leases()
+    with ThreadPoolExecutor(max_workers=downloaders + uploaders, thread_name_prefix="pipeline") as executor:
+        download_futures = [
+            executor.submit(_download_stage, buffer, per_user, albums_done)
+            for _ in range(downloaders)
+        ]
+        for _ in range(uploaders):
+            executor.submit(_upload_stage, buffer)
+        logic.drain_albums()
+        albums_done.set()
+        wait(download_futures)
+        buffer.close()
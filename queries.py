@@ -1,10 +1,13 @@
 import uuid
 from contextlib import contextmanager
+from datetime import datetime, timedelta, UTC
 
 import models
-from typing import Iterator
+from typing import Iterator, Iterable
 
-from sqlalchemy import create_engine, select, and_, func
+from sqlalchemy import create_engine, select, and_, func, or_, update, inspect, text, insert, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, sessionmaker
 from config import DATABASE_URL
 
@@ -23,12 +26,6 @@ def get_db() -> Iterator[Session]:
         session.commit()
 
 
-def get_albums_not_completed(db: Session) -> models.TaskTrackerAlbum | None:
-    query = select(models.TaskTrackerAlbum).where(models.TaskTrackerAlbum.completed.is_(False)).order_by(
-        models.TaskTrackerAlbum.updated_at.asc()).limit(1)
-    return db.scalars(query).one_or_none()
-
-
 def get_or_create_album_by_params(
         db: Session,
         tg_id: str | None,
@@ -37,6 +34,7 @@ def get_or_create_album_by_params(
 ) -> models.TaskTrackerAlbum:
     query = select(models.TaskTrackerAlbum).where(
         and_(
+            models.TaskTrackerAlbum.tg_id == tg_id,
             models.TaskTrackerAlbum.spotify_album_id == spotify_album_id,
             models.TaskTrackerAlbum.type == type,
         )
@@ -57,6 +55,42 @@ def get_or_create_album_by_params(
     return task
 
 
+def get_or_create_albums(
+        db: Session,
+        tg_id: str,
+        albums: Iterable[tuple[str, str]],
+) -> int:
+    """
+    Создаёт задачи на перенос пачки альбомов/плейлистов/треков пользователя в одной транзакции.
+    :param albums: пары (тип, spotify id), уже поставленные в очередь пропускаются
+    :return: количество созданных задач
+    """
+    albums = list(dict.fromkeys(albums))
+    existing = set()
+    for offset in range(0, len(albums), _BATCH_SIZE):
+        query = select(models.TaskTrackerAlbum.type, models.TaskTrackerAlbum.spotify_album_id).where(
+            models.TaskTrackerAlbum.tg_id == tg_id,
+            models.TaskTrackerAlbum.spotify_album_id.in_([_id for _, _id in albums[offset:offset + _BATCH_SIZE]]),
+        )
+        existing.update(db.execute(query).tuples().all())
+    rows = [
+        dict(
+            id=uuid.uuid4(),
+            tg_id=tg_id,
+            type=_type,
+            spotify_album_id=_id,
+            yandex_music_album_id=None,
+            completed=False,
+        )
+        for _type, _id in albums
+        if (_type, _id) not in existing
+    ]
+    if rows:
+        db.execute(insert(models.TaskTrackerAlbum.__table__), rows)
+    db.commit()
+    return len(rows)
+
+
 def get_or_create_track_by_params(
         db: Session,
         tg_id: str | None,
@@ -85,14 +119,546 @@ def get_or_create_track_by_params(
         completed=False,
     )
     db.add(task)
+    _add_album_progress(db, tg_id, spotify_album_id, total=1)
     db.commit()
     return task
 
 
-def get_track_not_completed(db: Session) -> models.TaskTrackerTrack | None:
-    query = select(models.TaskTrackerTrack).where(models.TaskTrackerTrack.completed.is_(False)).order_by(
-        models.TaskTrackerTrack.updated_at.asc()).limit(1)
-    return db.scalars(query).one_or_none()
+def _add_album_progress(db: Session, tg_id: str | None, spotify_album_id: str | None, **counters: int):
+    """Увеличивает счётчики прогресса альбома (total, completed, failed) в текущей транзакции."""
+    album = models.TaskTrackerAlbum
+    values = {f"tracks_{name}": getattr(album, f"tracks_{name}") + delta for name, delta in counters.items() if delta}
+    if not values:
+        return
+    db.execute(
+        update(album).where(
+            album.tg_id == tg_id,
+            album.spotify_album_id == spotify_album_id,
+        ).values(**values).execution_options(synchronize_session=False)
+    )
+
+
+# Ограничение на количество параметров в одном запросе (в SQLite их число ограничено)
+_BATCH_SIZE = 500
+
+
+def _insert_ignore_conflicts(db: Session, model):
+    """INSERT, пропускающий строки, которые уже есть по уникальному ключу."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model)
+
+
+def get_existing_track_ids(
+        db: Session,
+        tg_id: str | None,
+        spotify_album_id: str | None,
+        spotify_track_ids: list[str],
+        yandex_music_album_id: str | None,
+) -> set[str]:
+    """Какие из треков уже поставлены в очередь для этого альбома пользователя."""
+    existing = set()
+    for offset in range(0, len(spotify_track_ids), _BATCH_SIZE):
+        query = select(models.TaskTrackerTrack.spotify_track_id).where(
+            models.TaskTrackerTrack.tg_id == tg_id,
+            models.TaskTrackerTrack.spotify_album_id == spotify_album_id,
+            models.TaskTrackerTrack.yandex_music_album_id == yandex_music_album_id,
+            models.TaskTrackerTrack.spotify_track_id.in_(spotify_track_ids[offset:offset + _BATCH_SIZE]),
+        )
+        existing.update(db.scalars(query).all())
+    return existing
+
+
+def get_or_create_tracks(
+        db: Session,
+        tg_id: str | None,
+        spotify_album_id: str | None,
+        spotify_track_ids: Iterable[str | None],
+        yandex_music_album_id: str | None,
+        completed: dict[str, str] | None = None,
+) -> int:
+    """
+    Создаёт задачи на перенос сразу для пачки треков одного альбома в одной транзакции.
+    Треки без id (локальные файлы в плейлистах) пропускаются.
+    :param completed: треки, уже добавленные в плейлист: {spotify id: id трека яндекс музыки},
+        их задачи создаются сразу завершёнными
+    Возвращает количество созданных задач.
+    """
+    completed = completed or {}
+    # dict сохраняет порядок треков и убирает повторы
+    track_ids = list(dict.fromkeys(_id for _id in spotify_track_ids if _id is not None))
+    existing = get_existing_track_ids(db, tg_id, spotify_album_id, track_ids, yandex_music_album_id)
+    rows = [
+        dict(
+            id=uuid.uuid4(),
+            tg_id=tg_id,
+            spotify_album_id=spotify_album_id,
+            spotify_track_id=track_id,
+            yandex_music_album_id=yandex_music_album_id,
+            yandex_music_track_id=completed.get(track_id),
+            completed=track_id in completed,
+        )
+        for track_id in track_ids
+        if track_id not in existing
+    ]
+    created = 0
+    if rows:
+        result = db.execute(_insert_ignore_conflicts(db, models.TaskTrackerTrack.__table__), rows)
+        # Строки, вставленные параллельно другим воркером, пропущены и не считаются
+        created = result.rowcount if result.rowcount >= 0 else len(rows)
+        if created == len(rows):
+            linked = sum(1 for row in rows if row["completed"])
+            _add_album_progress(db, tg_id, spotify_album_id, total=created, completed=linked)
+        else:
+            # Неизвестно, какие именно строки пропущены, поэтому счётчики альбома пересчитываются
+            refresh_album_progress(
+                db.connection(),
+                models.TaskTrackerAlbum.tg_id == tg_id,
+                models.TaskTrackerAlbum.spotify_album_id == spotify_album_id,
+            )
+    db.commit()
+    return created
+
+
+def get_track_matches(db: Session, spotify_track_ids: list[str], miss_since: datetime) -> dict[str, models.TrackMatch]:
+    """
+    Сохранённые результаты поиска в каталоге по id треков Spotify.
+    Промахи старше miss_since не возвращаются, такие треки ищутся снова.
+    """
+    matches = {}
+    for offset in range(0, len(spotify_track_ids), _BATCH_SIZE):
+        query = select(models.TrackMatch).where(
+            models.TrackMatch.spotify_track_id.in_(spotify_track_ids[offset:offset + _BATCH_SIZE]),
+            or_(models.TrackMatch.yandex_track_id.is_not(None), models.TrackMatch.updated_at >= miss_since),
+        )
+        matches.update((match.spotify_track_id, match) for match in db.scalars(query))
+    return matches
+
+
+def get_track_matches_by_isrc(db: Session, isrcs: list[str]) -> dict[str, models.TrackMatch]:
+    """Найденные треки каталога по ISRC, например та же запись из другого альбома."""
+    matches = {}
+    for offset in range(0, len(isrcs), _BATCH_SIZE):
+        query = select(models.TrackMatch).where(
+            models.TrackMatch.isrc.in_(isrcs[offset:offset + _BATCH_SIZE]),
+            models.TrackMatch.yandex_track_id.is_not(None),
+        )
+        matches.update((match.isrc, match) for match in db.scalars(query))
+    return matches
+
+
+def save_track_matches(db: Session, rows: list[dict]) -> None:
+    """Записывает результаты поиска, заменяя прежние записи тех же треков."""
+    if not rows:
+        return
+    db.execute(delete(models.TrackMatch).where(
+        models.TrackMatch.spotify_track_id.in_([row["spotify_track_id"] for row in rows]),
+    ))
+    db.execute(insert(models.TrackMatch.__table__), [dict(id=uuid.uuid4(), **row) for row in rows])
+    db.commit()
+
+
+def has_tracks_not_completed(db: Session) -> bool:
+    """Есть ли треки, которые можно взять сейчас или которые уже в работе."""
+    query = select(models.TaskTrackerTrack.id).where(
+        models.TaskTrackerTrack.completed.is_(False),
+        or_(
+            models.TaskTrackerTrack.next_attempt_at <= datetime.now(UTC),
+            models.TaskTrackerTrack.lease_owner.is_not(None),
+        ),
+    ).limit(1)
+    return db.scalars(query).first() is not None
+
+
+def _lease_is_free(model, now: datetime):
+    return or_(
+        model.lease_owner.is_(None),
+        model.lease_expires_at.is_(None),
+        model.lease_expires_at < now,
+    )
+
+
+def _claim(db: Session, model, owner: str, lease_seconds: int, *filters, order_by=None, attempts: int = 5):
+    """
+    Атомарно берёт в аренду первую по order_by (по умолчанию самую давно обновлённую) незавершённую задачу.
+
+    На Postgres строка блокируется через FOR UPDATE SKIP LOCKED, на остальных базах
+    аренда ставится условным UPDATE: если его выполнил другой воркер, пробуем следующую строку.
+    """
+    for _ in range(attempts):
+        now = datetime.now(UTC)
+        query = select(model.id).where(
+            model.completed.is_(False),
+            _lease_is_free(model, now),
+            *filters,
+        ).order_by((order_by if order_by is not None else model.updated_at).asc()).limit(1)
+        if db.get_bind().dialect.name == "postgresql":
+            query = query.with_for_update(skip_locked=True)
+        task_id = db.scalars(query).one_or_none()
+        if task_id is None:
+            db.commit()
+            return None
+        result = db.execute(
+            update(model).where(
+                model.id == task_id,
+                model.completed.is_(False),
+                _lease_is_free(model, now),
+            ).values(
+                lease_owner=owner,
+                lease_expires_at=now + timedelta(seconds=lease_seconds),
+            ).execution_options(synchronize_session=False)
+        )
+        db.commit()
+        if result.rowcount == 1:
+            return db.get(model, task_id, populate_existing=True)
+    return None
+
+
+# Аренды скачанных треков, ждущих загрузки в конвейере, не считаются в лимит на пользователя
+STAGED_LEASE_SUFFIX = ":staged"
+
+
+def claim_album_not_completed(
+        db: Session,
+        owner: str,
+        lease_seconds: int,
+) -> models.TaskTrackerAlbum | None:
+    # Альбомы после неудачи ждут своей очереди, failed-альбомы без next_attempt_at не берутся вовсе
+    return _claim(
+        db, models.TaskTrackerAlbum, owner, lease_seconds,
+        models.TaskTrackerAlbum.next_attempt_at <= datetime.now(UTC),
+        order_by=models.TaskTrackerAlbum.next_attempt_at,
+    )
+
+
+def claim_track_not_completed(
+        db: Session,
+        owner: str,
+        lease_seconds: int,
+        per_user: int | None = None,
+) -> models.TaskTrackerTrack | None:
+    filters = []
+    if per_user is not None:
+        # Пользователи, у которых уже per_user активных аренд, пропускаются
+        busy_users = select(models.TaskTrackerTrack.tg_id).where(
+            models.TaskTrackerTrack.completed.is_(False),
+            models.TaskTrackerTrack.lease_owner.is_not(None),
+            models.TaskTrackerTrack.lease_expires_at >= datetime.now(UTC),
+            models.TaskTrackerTrack.lease_owner.not_like(f"%{STAGED_LEASE_SUFFIX}"),
+        ).group_by(models.TaskTrackerTrack.tg_id).having(func.count(models.TaskTrackerTrack.id) >= per_user)
+        filters.append(models.TaskTrackerTrack.tg_id.not_in(busy_users))
+    # Треки после неудачи ждут своей очереди, чтобы не мешать остальным
+    filters.append(models.TaskTrackerTrack.next_attempt_at <= datetime.now(UTC))
+    return _claim(
+        db, models.TaskTrackerTrack, owner, lease_seconds, *filters,
+        order_by=models.TaskTrackerTrack.next_attempt_at,
+    )
+
+
+def postpone_album(db: Session, task: models.TaskTrackerAlbum, delay: timedelta, error: str | None = None) -> None:
+    """Засчитывает неудачную попытку переноса альбома и откладывает следующую на delay."""
+    task.attempts += 1
+    task.next_attempt_at = datetime.now(UTC) + delay
+    task.last_error = error
+    db.add(task)
+    db.commit()
+
+
+def fail_album(db: Session, task: models.TaskTrackerAlbum, error: str | None = None) -> None:
+    """Засчитывает последнюю неудачную попытку и переносит задачу на альбом в failed."""
+    task.attempts += 1
+    task.failed = True
+    task.next_attempt_at = None
+    task.last_error = error
+    db.add(task)
+    db.commit()
+
+
+def postpone_track(db: Session, task: models.TaskTrackerTrack, delay: timedelta, error: str | None = None) -> None:
+    """Засчитывает неудачную попытку и откладывает следующую на delay."""
+    task.attempts += 1
+    task.next_attempt_at = datetime.now(UTC) + delay
+    task.last_error = error
+    db.add(task)
+    db.commit()
+
+
+def complete_track(db: Session, task: models.TaskTrackerTrack) -> None:
+    """Завершает трек и в той же транзакции засчитывает его в прогресс альбома."""
+    db.add(task)
+    result = db.execute(
+        update(models.TaskTrackerTrack).where(
+            models.TaskTrackerTrack.id == task.id,
+            models.TaskTrackerTrack.completed.is_(False),
+        ).values(completed=True)
+    )
+    # Трек, уже завершённый другим воркером, второй раз не считается
+    if result.rowcount == 1:
+        _add_album_progress(db, task.tg_id, task.spotify_album_id, completed=1)
+    db.commit()
+
+
+def fail_track(db: Session, task: models.TaskTrackerTrack, error: str | None = None) -> None:
+    """
+    Засчитывает последнюю неудачную попытку и переносит трек в failed.
+    Без next_attempt_at трек не попадает ни в выборку воркера, ни в расчёт времени ожидания.
+    """
+    task.attempts += 1
+    task.failed = True
+    task.next_attempt_at = None
+    task.last_error = error
+    db.add(task)
+    _add_album_progress(db, task.tg_id, task.spotify_album_id, failed=1)
+    db.commit()
+
+
+def get_failed_albums(db: Session, user_id: str, limit: int = 20) -> list[models.TaskTrackerAlbum]:
+    query = select(models.TaskTrackerAlbum).where(
+        models.TaskTrackerAlbum.tg_id == user_id,
+        models.TaskTrackerAlbum.failed.is_(True),
+    ).order_by(models.TaskTrackerAlbum.updated_at.desc()).limit(limit)
+    return list(db.scalars(query).all())
+
+
+def get_failed_tracks(db: Session, user_id: str, limit: int = 20) -> list[models.TaskTrackerTrack]:
+    query = select(models.TaskTrackerTrack).where(
+        models.TaskTrackerTrack.tg_id == user_id,
+        models.TaskTrackerTrack.failed.is_(True),
+    ).order_by(models.TaskTrackerTrack.updated_at.desc()).limit(limit)
+    return list(db.scalars(query).all())
+
+
+def requeue_failed_tracks(db: Session, user_id: str | None = None) -> int:
+    """Возвращает треки из failed в очередь с чистым счётчиком попыток. Без user_id - у всех пользователей."""
+    query = update(models.TaskTrackerTrack).where(
+        models.TaskTrackerTrack.failed.is_(True),
+        models.TaskTrackerTrack.completed.is_(False),
+    ).values(
+        failed=False,
+        attempts=0,
+        next_attempt_at=datetime.now(UTC),
+        last_error=None,
+    ).execution_options(synchronize_session=False)
+    if user_id is not None:
+        query = query.where(models.TaskTrackerTrack.tg_id == user_id)
+    result = db.execute(query)
+    album_filter = models.TaskTrackerAlbum.tracks_failed > 0
+    if user_id is not None:
+        album_filter = and_(album_filter, models.TaskTrackerAlbum.tg_id == user_id)
+    refresh_album_progress(db.connection(), album_filter)
+    db.commit()
+    return result.rowcount
+
+
+def requeue_failed_albums(db: Session, user_id: str | None = None) -> int:
+    """Возвращает задачи на альбомы из failed в очередь с чистым счётчиком попыток."""
+    query = update(models.TaskTrackerAlbum).where(
+        models.TaskTrackerAlbum.failed.is_(True),
+        models.TaskTrackerAlbum.completed.is_(False),
+    ).values(
+        failed=False,
+        attempts=0,
+        next_attempt_at=datetime.now(UTC),
+        last_error=None,
+    ).execution_options(synchronize_session=False)
+    if user_id is not None:
+        query = query.where(models.TaskTrackerAlbum.tg_id == user_id)
+    result = db.execute(query)
+    db.commit()
+    return result.rowcount
+
+
+def get_next_attempt_at(db: Session, model=models.TaskTrackerTrack) -> datetime | None:
+    """
+    Когда этот воркер сможет взять ближайшую задачу (по умолчанию трек): очередь свободной задачи
+    или конец аренды задачи, которую сейчас переносит другой воркер.
+    """
+    now = datetime.now(UTC)
+    free = _lease_is_free(model, now)
+    query = select(
+        func.min(model.next_attempt_at).filter(free),
+        func.min(model.lease_expires_at).filter(~free),
+    ).where(model.completed.is_(False))
+    deadlines = [deadline for deadline in db.execute(query).one() if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+
+def count_tracks_by_state(db: Session) -> dict[str, int]:
+    """Глубина очереди треков одним запросом: готовые к переносу, в работе, отложенные и failed."""
+    now = datetime.now(UTC)
+    track = models.TaskTrackerTrack
+    query = select(
+        func.count().filter(track.next_attempt_at <= now, _lease_is_free(track, now)).label("ready"),
+        func.count().filter(track.lease_owner.is_not(None), track.lease_expires_at >= now).label("leased"),
+        func.count().filter(track.next_attempt_at > now).label("postponed"),
+        func.count().filter(track.failed.is_(True)).label("failed"),
+    ).where(track.completed.is_(False))
+    return dict(db.execute(query).one()._mapping)
+
+
+def get_playlists_to_sync(db: Session, due_before: datetime, limit: int) -> list[models.TaskTrackerAlbum]:
+    """Перенесённые плейлисты, которые не проверялись с due_before, начиная с самых давних."""
+    album = models.TaskTrackerAlbum
+    query = select(album).where(
+        album.type == models.TaskTrackerAlbumType.playlist.value,
+        album.completed.is_(True),
+        or_(album.synced_at.is_(None), album.synced_at < due_before),
+    ).order_by(album.synced_at.asc()).limit(limit)
+    return list(db.scalars(query).all())
+
+
+def get_next_sync_at(db: Session) -> datetime | None:
+    """Когда последний раз проверялся самый давно проверенный перенесённый плейлист."""
+    album = models.TaskTrackerAlbum
+    query = select(func.min(album.synced_at)).where(
+        album.type == models.TaskTrackerAlbumType.playlist.value,
+        album.completed.is_(True),
+    )
+    return db.scalars(query).one()
+
+
+def claim_playlist_sync(db: Session, task: models.TaskTrackerAlbum, due_before: datetime) -> bool:
+    """
+    Отмечает проверку плейлиста условным UPDATE.
+    Возвращает False, если плейлист уже проверил другой воркер или его задача снова в очереди.
+    """
+    album = models.TaskTrackerAlbum
+    now = datetime.now(UTC)
+    result = db.execute(
+        update(album).where(
+            album.id == task.id,
+            album.completed.is_(True),
+            or_(album.synced_at.is_(None), album.synced_at < due_before),
+        ).values(synced_at=now).execution_options(synchronize_session=False)
+    )
+    db.commit()
+    if result.rowcount != 1:
+        return False
+    task.synced_at = now
+    return True
+
+
+def reopen_album(db: Session, task: models.TaskTrackerAlbum) -> None:
+    """Возвращает завершённую задачу на альбом в очередь, треки при этом остаются."""
+    task.completed = False
+    task.attempts = 0
+    task.failed = False
+    task.next_attempt_at = datetime.now(UTC)
+    task.last_error = None
+    db.add(task)
+    db.commit()
+
+
+def get_removed_tracks(
+        db: Session,
+        task: models.TaskTrackerAlbum,
+        spotify_track_ids: set[str],
+) -> list[models.TaskTrackerTrack]:
+    """
+    Задачи на треки альбома, которых нет среди spotify_track_ids.
+    Треки, которые сейчас переносит воркер, не возвращаются.
+    """
+    track = models.TaskTrackerTrack
+    # Треков в альбоме может быть больше, чем параметров в запросе, поэтому разница считается здесь
+    query = select(track).where(
+        track.tg_id == task.tg_id,
+        track.spotify_album_id == task.spotify_album_id,
+        track.yandex_music_album_id == task.yandex_music_album_id,
+        _lease_is_free(track, datetime.now(UTC)),
+    )
+    return [row for row in db.scalars(query).all() if row.spotify_track_id not in spotify_track_ids]
+
+
+def delete_tracks(db: Session, task: models.TaskTrackerAlbum, tracks: list[models.TaskTrackerTrack]) -> int:
+    """Удаляет задачи на треки альбома и пересчитывает его прогресс в одной транзакции."""
+    ids = [row.id for row in tracks]
+    for offset in range(0, len(ids), _BATCH_SIZE):
+        db.execute(
+            delete(models.TaskTrackerTrack).where(
+                models.TaskTrackerTrack.id.in_(ids[offset:offset + _BATCH_SIZE]),
+            ).execution_options(synchronize_session=False)
+        )
+    refresh_album_progress(db.connection(), models.TaskTrackerAlbum.id == task.id)
+    db.commit()
+    return len(ids)
+
+
+def renew_lease(
+        db: Session,
+        task: models.TaskTrackerAlbum | models.TaskTrackerTrack,
+        owner: str,
+        lease_seconds: int,
+) -> bool:
+    """Продлевает аренду. Возвращает False, если задачу уже забрал другой воркер."""
+    model = type(task)
+    result = db.execute(
+        update(model).where(
+            model.id == task.id,
+            model.lease_owner == owner,
+        ).values(
+            lease_expires_at=datetime.now(UTC) + timedelta(seconds=lease_seconds),
+        ).execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def rename_lease(
+        db: Session,
+        task: models.TaskTrackerAlbum | models.TaskTrackerTrack,
+        owner: str,
+        new_owner: str,
+) -> bool:
+    """Переписывает аренду на другого владельца. Возвращает False, если задачу уже забрал другой воркер."""
+    model = type(task)
+    result = db.execute(
+        update(model).where(
+            model.id == task.id,
+            model.lease_owner == owner,
+        ).values(lease_owner=new_owner).execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def release_lease(
+        db: Session,
+        task: models.TaskTrackerAlbum | models.TaskTrackerTrack,
+        owner: str,
+) -> None:
+    model = type(task)
+    db.execute(
+        update(model).where(
+            model.id == task.id,
+            model.lease_owner == owner,
+        ).values(
+            lease_owner=None,
+            lease_expires_at=None,
+        ).execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def reclaim_expired_leases(db: Session) -> int:
+    """Снимает просроченные аренды упавших воркеров. Возвращает количество освобождённых задач."""
+    now = datetime.now(UTC)
+    reclaimed = 0
+    for model in (models.TaskTrackerAlbum, models.TaskTrackerTrack):
+        result = db.execute(
+            update(model).where(
+                model.lease_owner.is_not(None),
+                model.lease_expires_at < now,
+            ).values(
+                lease_owner=None,
+                lease_expires_at=None,
+            ).execution_options(synchronize_session=False)
+        )
+        reclaimed += result.rowcount
+    db.commit()
+    return reclaimed
 
 
 def get_or_create_user_model(
@@ -116,38 +682,193 @@ def get_or_create_user_model(
     return entity
 
 
+def _track_progress():
+    """Количество треков альбома: всего, завершённых и в failed, одним GROUP BY."""
+    track = models.TaskTrackerTrack
+    return select(
+        track.tg_id,
+        track.spotify_album_id,
+        func.count(track.id).label("total"),
+        func.count(track.id).filter(track.completed.is_(True)).label("completed"),
+        func.count(track.id).filter(track.failed.is_(True)).label("failed"),
+    ).group_by(track.tg_id, track.spotify_album_id)
+
+
+def get_album_progress(
+        db: Session,
+        user_id: str | None,
+        page: int = 0,
+        page_size: int = 5,
+        materialized: bool = True,
+) -> tuple[list[tuple[str, int, int, int]], int]:
+    """
+    Страница задач пользователя с прогрессом по трекам за один запрос.
+    С materialized=True берутся счётчики, которые ведут воркеры, и запрос не зависит от числа треков,
+    иначе треки считаются группировкой по страничке альбомов.
+    :return: ([(spotify_album_id, всего, завершено, failed)], всего альбомов у пользователя)
+    """
+    album = models.TaskTrackerAlbum
+    albums = select(
+        album.spotify_album_id,
+        album.tracks_total,
+        album.tracks_completed,
+        album.tracks_failed,
+        album.created_at,
+        func.count().over().label("albums"),
+    ).where(album.tg_id == user_id).order_by(album.created_at.asc()).offset(page * page_size).limit(page_size)
+    if materialized:
+        rows = db.execute(albums).all()
+        return [row[:4] for row in rows], rows[0].albums if rows else 0
+    albums = albums.subquery()
+    progress = _track_progress().where(
+        models.TaskTrackerTrack.tg_id == user_id,
+        models.TaskTrackerTrack.spotify_album_id.in_(select(albums.c.spotify_album_id)),
+    ).subquery()
+    query = select(
+        albums.c.spotify_album_id,
+        func.coalesce(progress.c.total, 0),
+        func.coalesce(progress.c.completed, 0),
+        func.coalesce(progress.c.failed, 0),
+        albums.c.albums,
+    ).outerjoin(
+        progress, progress.c.spotify_album_id == albums.c.spotify_album_id,
+    ).order_by(albums.c.created_at.asc())
+    rows = db.execute(query).all()
+    return [row[:4] for row in rows], rows[0].albums if rows else 0
+
+
 def get_list_relations_tracks(
         db: Session,
         user_id: str | None,
+        page: int = 0,
+        page_size: int = 5,
 ) -> str:
+    entities, albums = get_album_progress(db=db, user_id=user_id, page=page, page_size=page_size)
     formated = []
-    query = select(models.TaskTrackerAlbum).where(
-        and_(
-            models.TaskTrackerAlbum.tg_id == user_id,
-        )
-    ).order_by(models.TaskTrackerAlbum.created_at.asc()).limit(5)
-    entities = db.scalars(query).all()
-    for entity in entities:
-        query = select(func.count(models.TaskTrackerTrack.id).label('count')).where(
-            and_(
-                models.TaskTrackerTrack.spotify_album_id == entity.spotify_album_id,
-                models.TaskTrackerTrack.tg_id == entity.tg_id,
-            ),
-        )
-        _all = db.scalars(query).one()
-        query = select(func.count(models.TaskTrackerTrack.id).label('count')).where(
-            and_(
-                models.TaskTrackerTrack.spotify_album_id == entity.spotify_album_id,
-                models.TaskTrackerTrack.tg_id == entity.tg_id,
-                models.TaskTrackerTrack.completed.is_(True),
-            ),
-        )
-        _completed = db.scalars(query).one()
-        formated.append(
-            f"[{entity.spotify_album_id}] [{_completed} / {_all}]"
-        )
+    for spotify_album_id, _all, _completed, _failed in entities:
+        line = f"[{spotify_album_id}] [{_completed} / {_all}]"
+        if _failed:
+            line += f" не удалось: {_failed}"
+        formated.append(line)
+    pages = -(-albums // page_size)
+    if formated and pages > 1:
+        footer = f"Страница {page + 1} из {pages}"
+        if page + 1 < pages:
+            footer += f", следующая: /list {page + 2}"
+        formated.append(footer)
     return "\n".join(formated)
 
 
+def refresh_album_progress(connection, *filters) -> int:
+    """
+    Пересчитывает счётчики прогресса альбомов по трекам.
+    Нужен для заполнения счётчиков существующих альбомов и после массовых изменений треков.
+    У альбома без треков (например, после удаления всех треков синхронизацией) счётчики обнуляются.
+    """
+    album = models.TaskTrackerAlbum
+    progress = _track_progress().subquery()
+    rows = connection.execute(
+        select(
+            album.id,
+            func.coalesce(progress.c.total, 0),
+            func.coalesce(progress.c.completed, 0),
+            func.coalesce(progress.c.failed, 0),
+        ).outerjoin(
+            progress,
+            and_(progress.c.tg_id == album.tg_id, progress.c.spotify_album_id == album.spotify_album_id),
+        ).where(*filters)
+    ).all()
+    for album_id, total, completed, failed in rows:
+        connection.execute(
+            update(album).where(album.id == album_id).values(
+                tracks_total=total,
+                tracks_completed=completed,
+                tracks_failed=failed,
+            )
+        )
+    return len(rows)
+
+
+def migrate(engine: Engine = _engine) -> list[str]:
+    """
+    Создаёт недостающие таблицы, добавляет недостающие колонки в существующие
+    и приводит индексы к объявленным в models (лишние ix_* удаляются).
+    Возвращает список выполненных изменений.
+    """
+    models.Base.metadata.create_all(engine)
+    applied = []
+    added = set()
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in models.Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                statement = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.server_default is not None:
+                    statement += f' DEFAULT {column.server_default.arg.text}'
+                    if not column.nullable:
+                        statement += ' NOT NULL'
+                connection.execute(text(statement))
+                applied.append(statement)
+                added.add(column.name)
+                # Новую колонку существующих строк заполняем из другой колонки
+                backfill_from = column.info.get("backfill_from")
+                if backfill_from:
+                    statement = f'UPDATE {table.name} SET {column.name} = {backfill_from} WHERE {column.name} IS NULL'
+                    connection.execute(text(statement))
+                    applied.append(statement)
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            declared_indexes = {index.name for index in table.indexes}
+            for name in sorted(existing_indexes - declared_indexes):
+                # Удаляем только индексы, созданные по соглашению об именах SQLAlchemy
+                if name.startswith("ix_"):
+                    connection.execute(text(f"DROP INDEX {name}"))
+                    applied.append(f"DROP INDEX {name}")
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique and table is models.TaskTrackerTrack.__table__:
+                    removed = _deduplicate_tracks(connection)
+                    if removed:
+                        applied.append(f"DELETE {removed} duplicate rows FROM {table.name}")
+                index.create(connection)
+                applied.append(f"CREATE INDEX {index.name} ON {table.name}")
+        if added & {"tracks_total", "tracks_completed", "tracks_failed"}:
+            refreshed = refresh_album_progress(connection)
+            applied.append(f"UPDATE {refreshed} rows SET tracks_* FROM task_tracker_track")
+        if applied:
+            # Без свежей статистики планировщик SQLite выбирает индекс очереди там, где нужен ключ
+            connection.execute(text("ANALYZE"))
+            applied.append("ANALYZE")
+    return applied
+
+
+def _deduplicate_tracks(connection) -> int:
+    """Удаляет повторы задач по естественному ключу, оставляя завершённую, если она есть."""
+    track = models.TaskTrackerTrack
+    rows = connection.execute(
+        select(
+            track.id,
+            track.tg_id,
+            track.spotify_album_id,
+            track.spotify_track_id,
+            track.yandex_music_album_id,
+        ).order_by(track.completed.desc(), track.created_at.asc())
+    ).all()
+    seen = set()
+    duplicates = []
+    for _id, *key in rows:
+        key = tuple(key)
+        if key in seen:
+            duplicates.append(_id)
+        seen.add(key)
+    for offset in range(0, len(duplicates), _BATCH_SIZE):
+        connection.execute(delete(track).where(track.id.in_(duplicates[offset:offset + _BATCH_SIZE])))
+    return len(duplicates)
+
+
 if __name__ == "__main__":
     models.Base.metadata.create_all(_engine)
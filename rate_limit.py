@@ -0,0 +1,239 @@
+"""
+Ограничение частоты запросов к Spotify и Яндекс Музыке на стороне клиента.
+
+Корзина токенов на сервис и ключ (приложение Spotify, токен Яндекс Музыки),
+общая для всех потоков процесса. Частота подстраивается под ответы сервиса:
+после 429 она снижается вдвое и запросы ждут Retry-After, затем частота
+постепенно возвращается к настроенной.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from datetime import datetime, UTC
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    SPOTIFY_RATE_LIMIT,
+    SPOTIFY_RATE_BURST,
+    YANDEX_RATE_LIMIT,
+    YANDEX_RATE_BURST,
+    RATE_LIMIT_MAX_WAIT,
+)
+
+SERVICE_SPOTIFY = "spotify"
+SERVICE_YANDEX = "yandex"
+
+# Сервис: (запросов в секунду, размер всплеска)
+RATE_LIMITS = {
+    SERVICE_SPOTIFY: (SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST),
+    SERVICE_YANDEX: (YANDEX_RATE_LIMIT, YANDEX_RATE_BURST),
+}
+# Ниже этой доли от настроенной частоты снижать не будем
+MIN_RATE_FRACTION = 0.05
+# За столько успешных запросов частота восстанавливается от нуля до настроенной
+RECOVERY_REQUESTS = 100
+# Сколько раз адаптер сам повторяет запрос, получивший 429
+THROTTLE_RETRIES = 3
+
+
+class RateLimitExceeded(Exception):
+    """Запросу пришлось бы ждать дольше допустимого, он не отправлен."""
+
+    # retry.classify_error считает такие ошибки ограничением частоты
+    http_status = 429
+
+    def __init__(self, name: str, wait: float):
+        super().__init__(f"Превышен rate limit {name}: очередь на {wait:.0f} с")
+        self.wait = wait
+
+
+@dataclass
+class RateLimiterStats:
+    name: str
+    # Текущая и настроенная частота, запросов в секунду
+    rate: float
+    max_rate: float
+    # Сколько секунд ждал бы запрос, отправленный сейчас
+    wait: float
+    requests: int
+    throttled: int
+    waited_seconds: float
+
+
+class RateLimiter:
+    """Корзина токенов с подстройкой частоты, безопасная для потоков и asyncio."""
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.requests = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        # Токены начисляются с этого момента, после 429 он сдвигается на Retry-After
+        self._refill_from = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self._refill_from:
+            self._tokens = min(self.burst, self._tokens + (now - self._refill_from) * self.rate)
+            self._refill_from = now
+
+    def _wait(self, now: float) -> float:
+        return max(self._refill_from - now, 0.0) + max(1 - self._tokens, 0.0) / self.rate
+
+    def reserve(self, max_wait: float = RATE_LIMIT_MAX_WAIT) -> float:
+        """
+        Занимает токен и возвращает, сколько секунд подождать перед запросом.
+        Ожидающие запросы уходят в долг корзины, поэтому очередь честная и без опроса.
+        :raises RateLimitExceeded: ждать пришлось бы дольше max_wait, токен не занят
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._wait(now)
+            if wait > max_wait:
+                raise RateLimitExceeded(self.name, wait)
+            self._tokens -= 1
+            self.requests += 1
+            self.waited_seconds += wait
+            return wait
+
+    def acquire(self, max_wait: float = RATE_LIMIT_MAX_WAIT) -> float:
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, max_wait: float = RATE_LIMIT_MAX_WAIT) -> float:
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def throttle(self, retry_after: float | None = None):
+        """Сервис ответил 429: снижает частоту и приостанавливает запросы на retry_after секунд."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled += 1
+            # Одновременно отправленные запросы получают 429 вместе, частота снижается один раз за паузу
+            if now >= self._refill_from:
+                self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_FRACTION)
+            if retry_after is None:
+                retry_after = 1 / self.rate
+            self._refill_from = max(self._refill_from, now + retry_after)
+            self._tokens = min(self._tokens, 0.0)
+            rate = self.rate
+        print(f"{self.name} ответил 429: частота {rate:.2f} запросов/с, пауза {retry_after:.1f} с")
+
+    def success(self):
+        """Запрос прошёл без 429: частота понемногу возвращается к настроенной."""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / RECOVERY_REQUESTS)
+
+    def stats(self) -> RateLimiterStats:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return RateLimiterStats(
+                name=self.name,
+                rate=self.rate,
+                max_rate=self.max_rate,
+                wait=self._wait(now),
+                requests=self.requests,
+                throttled=self.throttled,
+                waited_seconds=self.waited_seconds,
+            )
+
+
+def token_key(token: str) -> str:
+    """Ключ ограничителя для токена, сам токен в именах и статистике не светится."""
+    return hashlib.sha256(token.encode()).hexdigest()[:12]
+
+
+class RateLimiterRegistry:
+    """Ограничители процесса по сервису и ключу."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters: dict[tuple[str, str], RateLimiter] = {}
+
+    def get(self, service: str, key: str = "") -> RateLimiter:
+        with self._lock:
+            limiter = self._limiters.get((service, key))
+            if limiter is None:
+                rate, burst = RATE_LIMITS[service]
+                name = f"{service}:{key}" if key else service
+                limiter = self._limiters[(service, key)] = RateLimiter(name, rate, burst)
+            return limiter
+
+    def remove(self, service: str, key: str = ""):
+        with self._lock:
+            self._limiters.pop((service, key), None)
+
+    def stats(self) -> list[RateLimiterStats]:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return [limiter.stats() for limiter in limiters]
+
+
+rate_limiters = RateLimiterRegistry()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After в секундах: бывает числом секунд или HTTP-датой."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter, который берёт токен у ограничителя перед каждым запросом
+    и сам повторяет ответы 429 после Retry-After.
+    """
+
+    def __init__(self, limiter: RateLimiter, throttle_retries: int = THROTTLE_RETRIES, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.throttle_retries = throttle_retries
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        # Потоковое тело (загрузка файла) уже прочитано, такой запрос не повторить
+        retries = self.throttle_retries if isinstance(request.body, (bytes, str, type(None))) else 0
+        for attempt in range(retries + 1):
+            self.limiter.acquire()
+            response = super().send(request, **kwargs)
+            if response.status_code != 429:
+                self.limiter.success()
+                return response
+            self.limiter.throttle(parse_retry_after(response.headers.get("Retry-After")))
+            if attempt < retries:
+                response.close()
+        return response
+
+
+def mount_rate_limit(session: requests.Session, limiter: RateLimiter, **adapter_kwargs) -> requests.Session:
+    """Отправляет все запросы сессии через ограничитель."""
+    adapter = RateLimitedAdapter(limiter, **adapter_kwargs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
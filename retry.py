@@ -0,0 +1,85 @@
+"""
+Классы ошибок переноса трека и политика повторов для каждого класса.
+"""
+from datetime import timedelta
+
+import httpx
+import requests
+from yandex_music.exceptions import NetworkError, NotFoundError, TimedOutError
+
+from config import RETRY_BACKOFF_SECONDS, RETRY_BACKOFF_MAX_SECONDS, RETRY_MAX_ATTEMPTS
+
+ERROR_NOT_FOUND = "not_found"
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_NETWORK = "network"
+ERROR_UNKNOWN = "unknown"
+
+# Класс ошибки: (начальная задержка в секундах, сколько неудач до переноса в failed)
+RETRY_POLICY = {
+    # Трека нет ни в Spotify, ни у источников spotdl: повторять часто бессмысленно
+    ERROR_NOT_FOUND: (60 * 60, min(2, RETRY_MAX_ATTEMPTS)),
+    # Ограничение частоты снимается не сразу, но и трек с ним в порядке
+    ERROR_RATE_LIMITED: (5 * 60, RETRY_MAX_ATTEMPTS * 2),
+    ERROR_NETWORK: (RETRY_BACKOFF_SECONDS, RETRY_MAX_ATTEMPTS),
+    ERROR_UNKNOWN: (RETRY_BACKOFF_SECONDS, RETRY_MAX_ATTEMPTS),
+}
+
+
+class TrackTransferError(Exception):
+    """Ошибка переноса трека с уже известным классом."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_message(message: str) -> str:
+    message = message.lower()
+    if "429" in message or "too many requests" in message or "rate limit" in message:
+        return ERROR_RATE_LIMITED
+    if "no results found" in message or "not found" in message or "404" in message or "unavailable" in message:
+        return ERROR_NOT_FOUND
+    if "timed out" in message or "timeout" in message or "connection" in message or "network" in message:
+        return ERROR_NETWORK
+    return ERROR_UNKNOWN
+
+
+def classify_error(error: BaseException) -> str:
+    if isinstance(error, TrackTransferError):
+        return error.kind
+    # spotipy кладёт код в http_status, requests и httpx - в response
+    status = getattr(error, "http_status", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = error.response.status_code
+    if status == 429:
+        return ERROR_RATE_LIMITED
+    if status == 404 or isinstance(error, NotFoundError):
+        return ERROR_NOT_FOUND
+    # spotdl сообщает об отсутствии источников простым LookupError("No results found for song: ...").
+    # Остальные LookupError (KeyError, IndexError) - ошибки в коде, а не отсутствующий трек
+    if isinstance(error, LookupError):
+        if type(error) is LookupError and "no results found" in str(error).lower():
+            return ERROR_NOT_FOUND
+        return ERROR_UNKNOWN
+    if isinstance(error, (
+            requests.ConnectionError, requests.Timeout, httpx.TransportError,
+            ConnectionError, TimeoutError, TimedOutError,
+    )):
+        return ERROR_NETWORK
+    kind = classify_message(str(error))
+    if kind == ERROR_UNKNOWN and isinstance(error, NetworkError):
+        return ERROR_NETWORK
+    return kind
+
+
+def retry_delay(kind: str, attempts: int) -> timedelta:
+    """Экспоненциальная задержка перед попыткой номер attempts + 1."""
+    base, _ = RETRY_POLICY[kind]
+    seconds = base * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(seconds, RETRY_BACKOFF_MAX_SECONDS))
+
+
+def is_exhausted(kind: str, attempts: int) -> bool:
+    """Исчерпан ли бюджет попыток после attempts неудач."""
+    _, max_attempts = RETRY_POLICY[kind]
+    return attempts >= max_attempts
@@ -0,0 +1,63 @@
+"""
+Разбор ссылок Spotify без запросов к API.
+
+Поддерживаются:
+    https://open.spotify.com/album/<id>?si=...
+    https://open.spotify.com/intl-de/playlist/<id>
+    https://open.spotify.com/embed/track/<id>
+    https://open.spotify.com/user/<user>/playlist/<id>
+    https://open.spotify.com/user/<user> и spotify:user:<user>, если среди types есть user
+    spotify:album:<id>, spotify:user:<user>:playlist:<id>
+    <id> без ссылки - id альбома, как раньше, когда id передавался в Spotify API сначала как альбом
+"""
+import re
+from urllib.parse import unquote, urlsplit
+
+# id объекта Spotify: 22 символа base62
+SPOTIFY_ID = re.compile(r"^[0-9A-Za-z]{22}$")
+_WEB_HOSTS = ("open.spotify.com", "play.spotify.com")
+# Короткие ссылки приложения раскрываются только редиректом, то есть запросом в сеть
+_SHORT_HOSTS = ("spotify.link", "spotify.app.link")
+
+
+def parse_spotify_url(url: str, types: tuple[str, ...] = ("album", "playlist", "track")) -> tuple[str, str]:
+    """
+    Определяет тип и id объекта по ссылке или URI Spotify.
+    :param url: ссылка, которую прислал пользователь
+    :param types: допустимые типы объектов
+    :return: (тип, id)
+    :raises ValueError: ссылка не разобрана или ведёт на объект другого типа
+    """
+    url = url.strip().strip("<>")
+    if SPOTIFY_ID.match(url):
+        if "album" not in types:
+            raise ValueError(f"По одному id не понять, что это, пришлите ссылку Spotify целиком: {url}")
+        return "album", url
+    if url.startswith("spotify:"):
+        parts = url.split(":")[1:]
+    else:
+        # Ссылку без схемы разбираем как https, но в сообщениях показываем то, что прислал пользователь
+        split = urlsplit(url if "://" in url else f"https://{url}")
+        host = split.hostname or ""
+        if host in _SHORT_HOSTS:
+            raise ValueError("Короткие ссылки spotify.link не поддерживаются, откройте её и пришлите полную ссылку")
+        if host not in _WEB_HOSTS:
+            raise ValueError(f"Это не ссылка Spotify: {url}")
+        parts = [part for part in split.path.split("/") if part]
+        # Префиксы локали и встраиваемого плеера не влияют на объект
+        while parts and (parts[0].startswith("intl-") or parts[0] == "embed"):
+            parts = parts[1:]
+    # Старый формат плейлистов: user/<user>/playlist/<id>
+    if len(parts) == 4 and parts[0] == "user" and parts[2] == "playlist":
+        parts = parts[2:]
+    if len(parts) != 2:
+        raise ValueError(f"Не удалось разобрать ссылку Spotify: {url}")
+    _type, _id = parts
+    if _type not in types:
+        raise ValueError(f"Ссылки на {_type} не поддерживаются, подходят: {', '.join(types)}")
+    # У пользователей вместо id обычно имя, которое выбрал сам пользователь
+    if _type == "user":
+        return _type, unquote(_id)
+    if not SPOTIFY_ID.match(_id):
+        raise ValueError(f"Некорректный id Spotify: {_id}")
+    return _type, _id
@@ -0,0 +1,127 @@
+"""
+Общее для всех пользователей хранилище скачанных треков.
+
+Файлы лежат по хешу содержимого (blobs/ab/abcdef....mp3), а для каждого
+id трека Spotify есть ссылка refs/<track_id>.json с хешем и размером.
+Один и тот же трек, добавленный разными пользователями, скачивается один раз.
+Объём ограничен квотой: при превышении удаляются давно не использованные файлы.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from config import TRACK_STORE_DIR, TRACK_STORE_QUOTA_BYTES, TRACK_STORE_VERIFY
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TrackStore:
+
+    def __init__(self, root: str | Path, quota_bytes: int, verify: bool = True):
+        self.root = Path(root)
+        self.quota_bytes = quota_bytes
+        self.verify = verify
+        self._blobs = self.root / "blobs"
+        self._refs = self.root / "refs"
+        self._blobs.mkdir(parents=True, exist_ok=True)
+        self._refs.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, path: Path) -> bool:
+        return path.resolve().is_relative_to(self.root.resolve())
+
+    def _ref_path(self, track_id: str) -> Path:
+        return self._refs / f"{track_id}.json"
+
+    def _blob_path(self, sha256: str, suffix: str) -> Path:
+        return self._blobs / sha256[:2] / f"{sha256}{suffix}"
+
+    def get(self, track_id: str) -> Path | None:
+        """Путь к сохранённому треку или None, если его нет или файл повреждён."""
+        blob = self._lookup(track_id)
+        with self._lock:
+            if blob is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return blob
+
+    def _lookup(self, track_id: str) -> Path | None:
+        try:
+            ref = json.loads(self._ref_path(track_id).read_text())
+        except (OSError, ValueError):
+            return None
+        blob = self._blob_path(ref["sha256"], ref["suffix"])
+        try:
+            valid = blob.stat().st_size == ref["size"]
+            if valid and self.verify:
+                valid = file_sha256(blob) == ref["sha256"]
+        except OSError:
+            valid = False
+        if not valid:
+            print(f"Трек {track_id} в хранилище повреждён или удалён")
+            self._ref_path(track_id).unlink(missing_ok=True)
+            blob.unlink(missing_ok=True)
+            return None
+        # Время изменения используется как время последнего обращения для LRU
+        os.utime(blob)
+        return blob
+
+    def put(self, track_id: str, path: Path) -> Path:
+        """Переносит скачанный файл в хранилище и возвращает его новый путь."""
+        sha256 = file_sha256(path)
+        size = path.stat().st_size
+        blob = self._blob_path(sha256, path.suffix)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        if blob.exists():
+            path.unlink(missing_ok=True)
+            os.utime(blob)
+        else:
+            shutil.move(path, blob)
+        ref = self._ref_path(track_id)
+        tmp = ref.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps({"sha256": sha256, "size": size, "suffix": path.suffix}))
+        os.replace(tmp, ref)
+        self.evict()
+        return blob
+
+    def evict(self):
+        """Удаляет давно не использованные файлы, пока объём больше квоты."""
+        with self._lock:
+            blobs = []
+            for blob in self._blobs.glob("*/*"):
+                try:
+                    stat = blob.stat()
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, blob))
+            total = sum(size for _, size, _ in blobs)
+            for _, size, blob in sorted(blobs):
+                if total <= self.quota_bytes:
+                    break
+                # Ссылки на удалённый файл отбросит _lookup
+                blob.unlink(missing_ok=True)
+                total -= size
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else 0.0,
+            }
+
+
+track_store = TrackStore(TRACK_STORE_DIR, TRACK_STORE_QUOTA_BYTES, TRACK_STORE_VERIFY) if TRACK_STORE_DIR else None
@@ -1,6 +1,82 @@
 import io
 import pathlib
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator
+
+import requests
 import yandex_music
+from yandex_music.exceptions import (
+    BadRequestError,
+    NetworkError,
+    NotFoundError,
+    TimedOutError,
+    UnauthorizedError,
+    YandexMusicError,
+)
+from yandex_music.utils.difference import Difference
+from yandex_music.utils.request import Request, USER_AGENT, default_timeout
+
+from config import YANDEX_CLIENT_IDLE_SECONDS, PLAYLIST_BATCH_TRACKS, PLAYLIST_BATCH_SECONDS
+from rate_limit import SERVICE_YANDEX, RateLimiter, mount_rate_limit, rate_limiters, token_key
+
+
+class SessionRequest(Request):
+    """
+    Request, который держит keep-alive соединения в requests.Session вместо нового на каждый запрос.
+    С limiter все запросы клиента проходят через ограничитель частоты.
+    """
+
+    def __init__(self, *args, limiter: RateLimiter | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        if limiter is not None:
+            mount_rate_limit(self.session, limiter)
+
+    def _request_wrapper(self, *args, **kwargs):
+        # Повторяет Request._request_wrapper, но отправляет запрос через сессию
+        if 'headers' not in kwargs:
+            kwargs['headers'] = {}
+
+        kwargs['headers']['User-Agent'] = USER_AGENT
+
+        if kwargs['timeout'] is default_timeout:
+            kwargs['timeout'] = self._timeout
+
+        try:
+            resp = self.session.request(*args, **kwargs)
+        except requests.Timeout as e:
+            raise TimedOutError from e
+        except requests.RequestException as e:
+            raise NetworkError(e) from e
+
+        if 200 <= resp.status_code <= 299:
+            return resp.content
+
+        try:
+            parse = self._parse(resp.content)
+            message = parse.get_error()
+        except YandexMusicError:
+            message = 'Unknown HTTPError'
+
+        if resp.status_code in (401, 403):
+            raise UnauthorizedError(message)
+        if resp.status_code == 400:
+            raise BadRequestError(message)
+        if resp.status_code == 404:
+            raise NotFoundError(message)
+        if resp.status_code in (409, 413):
+            raise NetworkError(message)
+
+        if resp.status_code == 502:
+            raise NetworkError('Bad Gateway')
+
+        raise NetworkError(f'{message} ({resp.status_code}): {resp.content}')
+
+    def close(self):
+        self.session.close()
 
 
 class YaMusicClient(yandex_music.Client):
@@ -10,12 +86,17 @@ class YaMusicClient(yandex_music.Client):
             self,
             path: pathlib.Path,
             playlist_id: str,
+            progress: Callable[[int, int], None] | None = None,
     ) -> str:
         """Загрузка трека в альбом.
 
+        Note:
+            Файл отправляется потоком частями и закрывается сразу после загрузки.
+
         Args:
             path (:obj:`str`): Путь до файла скаченного.
             playlist_id (:obj:`str`): Идентификатор полного плейлиста.
+            progress (:obj:`callable`, optional): Вызывается с (отправлено байт, всего байт).
         """
         owner_id, _ = playlist_id.split(":")
         params = {
@@ -33,35 +114,295 @@ class YaMusicClient(yandex_music.Client):
         url_download = result_init["post_target"]
         track_id = result_init["ugc_track_id"]
 
-        result_download = self._request.post(
-            url_download,
-            files={
-                "file": path.open("rb")
-            }
-        )
+        with path.open("rb") as file:
+            self._post_multipart(url_download, MultipartFileStream("file", file, path.name, progress))
 
         return track_id
 
     @yandex_music.client.log
     def upload_cover(
             self,
-            bytes_io: io.BytesIO,
+            file: BinaryIO,
             playlist_id: str,
+            progress: Callable[[int, int], None] | None = None,
     ) -> int:
         """Загрузка обложки в альбом.
 
         Args:
-            bytes_io (:obj:`str`): IO контейнер.
+            file (:obj:`BinaryIO`): Файл с изображением, отправляется потоком с начала.
             playlist_id (:obj:`str`): Идентификатор полного плейлиста.
+            progress (:obj:`callable`, optional): Вызывается с (отправлено байт, всего байт).
         """
-        bytes_io.seek(0)
         owner_id, album_id = playlist_id.split(":")
         url = f"{self.base_url}/users/{owner_id}/playlists/{album_id}/cover/upload"
 
-        response = self._request.post(
+        response = self._post_multipart(url, MultipartFileStream("image", file, "cover.jpg", progress))
+        return response["uid"]
+
+    @yandex_music.client.log
+    def users_playlists_insert_tracks(
+            self,
+            playlist_id: str,
+            tracks: list[tuple[str, str]],
+            attempts: int = 3,
+    ) -> yandex_music.Playlist | None:
+        """Добавление пачки треков в конец плейлиста одним изменением.
+
+        Note:
+            Ревизия берётся у текущего плейлиста. Если плейлист успели изменить
+            (например, загрузкой в него трека), ревизия перечитывается и запрос повторяется.
+
+        Args:
+            playlist_id (:obj:`str`): Идентификатор полного плейлиста.
+            tracks (:obj:`list` из :obj:`tuple`): Пары (id трека, id альбома) в порядке добавления.
+            attempts (:obj:`int`, optional): Сколько раз пробовать при конфликте ревизий.
+        """
+        owner_id, kind = playlist_id.split(":")
+        tracks = [{"id": track_id, "album_id": album_id} for track_id, album_id in tracks]
+        for attempt in range(attempts):
+            playlist = self.users_playlists(kind, user_id=owner_id)
+            diff = Difference().add_insert(playlist.track_count, tracks)
+            try:
+                return self.users_playlists_change(kind, diff.to_json(), playlist.revision, user_id=owner_id)
+            except (BadRequestError, NetworkError) as e:
+                if attempt + 1 >= attempts or not _is_revision_conflict(e):
+                    raise
+
+    @yandex_music.client.log
+    def users_playlists_delete_tracks(
+            self,
+            playlist_id: str,
+            track_ids: list[str],
+            attempts: int = 3,
+    ) -> yandex_music.Playlist | None:
+        """Удаление треков из плейлиста одним изменением.
+
+        Note:
+            Позиции треков и ревизия берутся у текущего плейлиста, при конфликте ревизий
+            плейлист перечитывается и запрос повторяется, как в users_playlists_insert_tracks.
+
+        Args:
+            playlist_id (:obj:`str`): Идентификатор полного плейлиста.
+            track_ids (:obj:`list` из :obj:`str`): Идентификаторы треков, удаляются все их вхождения.
+            attempts (:obj:`int`, optional): Сколько раз пробовать при конфликте ревизий.
+        """
+        owner_id, kind = playlist_id.split(":")
+        track_ids = {str(track_id) for track_id in track_ids}
+        for attempt in range(attempts):
+            playlist = self.users_playlists(kind, user_id=owner_id)
+            positions = [i for i, track in enumerate(playlist.tracks or []) if str(track.id) in track_ids]
+            if not positions:
+                return playlist
+            diff = Difference()
+            # С конца, чтобы удаление не сдвигало позиции следующих треков
+            for position in reversed(positions):
+                diff.add_delete(position, position + 1)
+            try:
+                return self.users_playlists_change(kind, diff.to_json(), playlist.revision, user_id=owner_id)
+            except (BadRequestError, NetworkError) as e:
+                if attempt + 1 >= attempts or not _is_revision_conflict(e):
+                    raise
+
+    def _post_multipart(self, url: str, stream: "MultipartFileStream") -> dict | str:
+        # Request.post сам передаёт headers, поэтому Content-Type с boundary задаём через обёртку
+        result = self._request._request_wrapper(
+            'POST',
             url,
-            files={
-                "image": bytes_io
-            },
+            headers={**self._request.headers, 'Content-Type': stream.content_type},
+            proxies=self._request.proxies,
+            data=stream,
+            timeout=default_timeout,
         )
-        return response["uid"]
+        return self._request._parse(result).get_result()
+
+
+def _is_revision_conflict(error: YandexMusicError) -> bool:
+    message = str(error).lower()
+    return "revision" in message or "(412)" in message or "(409)" in message
+
+
+class PlaylistInsertBatch:
+    """
+    Копит треки для одного плейлиста и добавляет их одним изменением
+    на каждые max_tracks треков или раз в max_seconds.
+    """
+
+    def __init__(
+            self,
+            client: YaMusicClient,
+            playlist_id: str,
+            max_tracks: int = PLAYLIST_BATCH_TRACKS,
+            max_seconds: float = PLAYLIST_BATCH_SECONDS,
+    ):
+        self.client = client
+        self.playlist_id = playlist_id
+        self.max_tracks = max_tracks
+        self.max_seconds = max_seconds
+        self._tracks: list[tuple[str, str, str]] = []
+        self._started_at = 0.0
+        self.on_flush: Callable[[list[str]], None] | None = None
+
+    def add(self, key: str, track_id: str, album_id: str):
+        """
+        Добавляет трек в пачку. key возвращается в on_flush, когда трек оказался в плейлисте.
+        """
+        if not self._tracks:
+            self._started_at = time.monotonic()
+        self._tracks.append((key, track_id, album_id))
+        if len(self._tracks) >= self.max_tracks or time.monotonic() - self._started_at >= self.max_seconds:
+            self.flush()
+
+    def flush(self) -> list[str]:
+        """Добавляет накопленные треки в плейлист и возвращает их key."""
+        if not self._tracks:
+            return []
+        tracks, self._tracks = self._tracks, []
+        self.client.users_playlists_insert_tracks(
+            self.playlist_id,
+            [(track_id, album_id) for _, track_id, album_id in tracks],
+        )
+        keys = [key for key, _, _ in tracks]
+        if self.on_flush is not None:
+            self.on_flush(keys)
+        return keys
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+
+class MultipartFileStream:
+    """Тело multipart/form-data с одним файлом, которое requests отправляет частями.
+
+    Длина известна заранее, поэтому запрос уходит с Content-Length, а не chunked.
+    Файл целиком в память не читается.
+    """
+
+    def __init__(
+            self,
+            field: str,
+            file: BinaryIO,
+            filename: str,
+            progress: Callable[[int, int], None] | None = None,
+            chunk_size: int = 64 * 1024,
+    ):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.chunk_size = chunk_size
+        self._progress = progress
+        head = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        file.seek(0, io.SEEK_END)
+        self._length = len(head) + file.tell() + len(tail)
+        file.seek(0)
+        self._parts = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self._sent = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.read(self.chunk_size):
+            yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0 and self._parts:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b"".join(chunks)
+        self._sent += len(data)
+        if data and self._progress is not None:
+            self._progress(self._sent, self._length)
+        return data
+
+
+class YaMusicClientPool:
+    """Клиенты Яндекс.Музыки по токену: init() и соединения переиспользуются между задачами."""
+
+    def __init__(self, idle_seconds: int = YANDEX_CLIENT_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._clients: dict[str, tuple[YaMusicClient, float]] = {}
+        # Сколько задач сейчас работает с клиентом токена, такие клиенты evict_idle не закрывает
+        self._in_use: dict[str, int] = {}
+
+    def get(self, token: str) -> YaMusicClient:
+        self.evict_idle()
+        with self._lock:
+            if token in self._clients:
+                client, _ = self._clients[token]
+                self._clients[token] = (client, time.monotonic())
+                return client
+        # Ограничитель у токена свой и переживает пересоздание клиента после простоя
+        limiter = rate_limiters.get(SERVICE_YANDEX, token_key(token))
+        client = YaMusicClient(token, request=SessionRequest(limiter=limiter)).init()
+        with self._lock:
+            # Пока шёл init(), клиента для токена мог создать другой поток
+            existing, _ = self._clients.get(token, (None, None))
+            if existing is not None:
+                client.request.close()
+                client = existing
+            self._clients[token] = (client, time.monotonic())
+        return client
+
+    def checkout(self, token: str) -> YaMusicClient:
+        """Клиент токена, который не будет закрыт как простаивающий до release(token)."""
+        with self._lock:
+            self._in_use[token] = self._in_use.get(token, 0) + 1
+        try:
+            return self.get(token)
+        except BaseException:
+            self.release(token)
+            raise
+
+    def release(self, token: str):
+        """Задача закончила работу с клиентом, полученным через checkout()."""
+        with self._lock:
+            count = self._in_use.pop(token, 0) - 1
+            if count > 0:
+                self._in_use[token] = count
+            elif token in self._clients:
+                # Простой отсчитывается с момента, когда клиент перестал использоваться
+                self._clients[token] = (self._clients[token][0], time.monotonic())
+
+    @contextmanager
+    def use(self, token: str) -> Iterator[YaMusicClient]:
+        """checkout() на время блока."""
+        client = self.checkout(token)
+        try:
+            yield client
+        finally:
+            self.release(token)
+
+    def invalidate(self, token: str | None):
+        """Забывает клиента токена, например после смены или отзыва токена."""
+        with self._lock:
+            client, _ = self._clients.pop(token, (None, None))
+        if token:
+            rate_limiters.remove(SERVICE_YANDEX, token_key(token))
+        if client is not None:
+            client.request.close()
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [
+                token for token, (_, used_at) in self._clients.items()
+                if used_at < deadline and token not in self._in_use
+            ]
+            clients = [self._clients.pop(token)[0] for token in idle]
+        for client in clients:
+            client.request.close()
+
+
+yandex_clients = YaMusicClientPool()